@@ -0,0 +1,287 @@
+"""
+Benchmarks the Permissions cog's hot paths without connecting to Discord.
+
+Run it from the root of your Red install (so `cogs.utils` can be imported):
+
+    python3 path/to/permissions/bench_permissions.py --sizes 10 100 1000 10000
+
+Every size builds a fake bot with fake servers, channels, roles, members and
+commands, writes a perms fixture holding that many rules into a temporary
+data folder and then times Check/resolve_permission, _is_locked and
+add_checks_to_all against it.
+"""
+import argparse
+import asyncio
+import importlib.util
+import os
+import random
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+from types import SimpleNamespace
+
+from tabulate import tabulate
+
+# permissions.py does `from __main__ import send_cmd_help, settings`, so this
+#   script has to provide them before the cog gets imported.
+settings = SimpleNamespace(owner="0")
+
+
+async def send_cmd_help(ctx):
+    pass
+
+
+COGS = ["Audio", "General", "Economy", "Mod", "Trivia"]
+COMMANDS_PER_COG = 10
+SUBCOMMANDS = 3
+
+
+class FakeCommand:
+    def __init__(self, name, cog_name, parent=None):
+        self.name = name
+        self.cog_name = cog_name
+        self.parent = parent
+        self.checks = []
+        self.commands = {}
+        if parent is None:
+            self.qualified_name = name
+        else:
+            self.qualified_name = parent.qualified_name + " " + name
+
+
+class FakeBot:
+    def __init__(self, loop, servers):
+        self.loop = loop
+        self.servers = servers
+        self.settings = settings
+        self.commands = {}
+        self.cogs = {}
+        self._channels = {c.id: c for s in servers for c in s.channels}
+
+    def add_command(self, command):
+        self.commands[command.name] = command
+
+    def remove_command(self, name):
+        return self.commands.pop(name, None)
+
+    def get_cog(self, name):
+        return self.cogs.get(name)
+
+    def get_channel(self, channel_id):
+        return self._channels.get(channel_id)
+
+
+def load_cog_module():
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        "permissions.py")
+    spec = importlib.util.spec_from_file_location("permissions", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def make_servers(count, channels, roles, members, rng):
+    servers = []
+    for s in range(count):
+        server = SimpleNamespace(id="1{:05d}".format(s),
+                                 name="server{}".format(s))
+        server.channels = [
+            SimpleNamespace(id="2{:05d}{:04d}".format(s, c),
+                            name="channel{}".format(c), server=server,
+                            is_private=False)
+            for c in range(channels)]
+        server.roles = [
+            SimpleNamespace(id="3{:05d}{:04d}".format(s, r),
+                            name="@everyone" if r == 0 else "role{}".format(r),
+                            position=r, server=server)
+            for r in range(roles)]
+        server.members = []
+        for m in range(members):
+            extra = min(len(server.roles) - 1, rng.randint(0, 5))
+            member_roles = [server.roles[0]] + rng.sample(server.roles[1:],
+                                                          extra)
+            server.members.append(SimpleNamespace(
+                id="4{:05d}{:04d}".format(s, m), name="member{}".format(m),
+                roles=member_roles, server=server))
+        servers.append(server)
+    return servers
+
+
+def make_commands():
+    commands = []
+    for cog in COGS:
+        for i in range(COMMANDS_PER_COG):
+            cmd = FakeCommand("{}{}".format(cog.lower(), i), cog)
+            commands.append(cmd)
+            if i % 3 == 0:
+                for j in range(SUBCOMMANDS):
+                    sub = FakeCommand("sub{}".format(j), cog, cmd)
+                    cmd.commands[sub.name] = sub
+                    commands.append(sub)
+    return commands
+
+
+def write_fixture(module, servers, commands, rules, rng):
+    """Writes `rules` rules spread over every server in the current format"""
+    os.makedirs(module.SERVERS_PATH)
+    shards = {}
+    locks = {}
+    for _ in range(rules):
+        server = rng.choice(servers)
+        command = rng.choice(commands).qualified_name.replace(" ", ".")
+        locks.setdefault(command, {"GLOBAL": False, "COGS": []})
+        entry = shards.setdefault(server.id, {}).setdefault(command, {
+            "CHANNELS": {}, "ROLES": {}, "LOCKED": False,
+            "LOCKED_CHANNELS": {}})
+
+        verdict = rng.choice("+-") + command
+        kind = rng.random()
+        if kind < 0.45:
+            entry["CHANNELS"][rng.choice(server.channels).id] = verdict
+        elif kind < 0.95:
+            entry["ROLES"][rng.choice(server.roles).id] = verdict
+        elif kind < 0.98:
+            entry["LOCKED_CHANNELS"][rng.choice(server.channels).id] = True
+        else:
+            entry["LOCKED"] = True
+
+    module.dataIO.save_json(module.PERMS_PATH,
+                            {"VERSION": module.PERMS_VERSION, "LOCKS": locks})
+    for server_id, shard in shards.items():
+        module.dataIO.save_json(os.path.join(
+            module.SERVERS_PATH, "{}.json".format(server_id)), shard)
+
+
+def make_contexts(bot, servers, commands, count, rng):
+    contexts = []
+    for _ in range(count):
+        server = rng.choice(servers)
+        command = rng.choice(commands)
+        message = SimpleNamespace(server=server,
+                                  channel=rng.choice(server.channels),
+                                  author=rng.choice(server.members))
+        contexts.append(SimpleNamespace(bot=bot, command=command,
+                                        message=message))
+    return contexts
+
+
+def time_calls(func, args_list):
+    timings = []
+    start = time.perf_counter()
+    for args in args_list:
+        t0 = time.perf_counter()
+        func(*args)
+        timings.append(time.perf_counter() - t0)
+    total = time.perf_counter() - start
+    return timings, total
+
+
+def summarize(name, rules, timings, total):
+    timings = sorted(timings)
+
+    def pct(p):
+        return timings[min(len(timings) - 1, int(len(timings) * p))] * 1e6
+
+    return [name, rules, len(timings), "{:.2f}".format(pct(0.5)),
+            "{:.2f}".format(pct(0.9)), "{:.2f}".format(pct(0.99)),
+            "{:.2f}".format(statistics.mean(timings) * 1e6),
+            "{:,.0f}".format(len(timings) / total if total else 0)]
+
+
+def bench_size(module, rules, args, rng):
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+
+    servers = make_servers(max(1, rules // 100), args.channels, args.roles,
+                           args.members, rng)
+    commands = make_commands()
+    write_fixture(module, servers, commands, rules, rng)
+
+    bot = FakeBot(loop, servers)
+    for command in commands:
+        if command.parent is None:
+            bot.add_command(command)
+
+    t0 = time.perf_counter()
+    cog = module.Permissions(bot)
+    load_time = time.perf_counter() - t0
+    bot.cogs["Permissions"] = cog
+
+    contexts = make_contexts(bot, servers, commands, args.checks, rng)
+
+    def check(ctx):
+        # What discord.py does before invoking a command
+        return all(c(ctx) for c in ctx.command.checks)
+
+    rows = []
+    # Cold: every call has to compile its (command, server) pair again
+    cold = []
+    for ctx in contexts[:min(len(contexts), 2000)]:
+        cog._compiled.clear()
+        cog._decisions = module.DecisionCache(module.DECISION_CACHE_SIZE)
+        t0 = time.perf_counter()
+        check(ctx)
+        cold.append(time.perf_counter() - t0)
+    rows.append(summarize("resolve (cold)", rules, cold, sum(cold)))
+
+    timings, total = time_calls(check, [(ctx, ) for ctx in contexts])
+    rows.append(summarize("resolve (warm)", rules, timings, total))
+
+    lock_args = [(ctx.command.qualified_name.replace(" ", "."),
+                  ctx.message.server, ctx.message.channel)
+                 for ctx in contexts]
+    timings, total = time_calls(cog._is_locked, lock_args)
+    rows.append(summarize("_is_locked", rules, timings, total))
+
+    timings, total = time_calls(cog.add_checks_to_all,
+                                [()] * max(1, args.checks // 1000))
+    rows.append(summarize("add_checks_to_all", rules, timings, total))
+
+    cog._Permissions__unload()
+    loop.close()
+    return rows, load_time
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--sizes", type=int, nargs="+",
+                        default=[10, 100, 1000, 10000],
+                        help="number of rules in each fixture")
+    parser.add_argument("--checks", type=int, default=20000,
+                        help="permission checks timed per fixture")
+    parser.add_argument("--channels", type=int, default=50)
+    parser.add_argument("--roles", type=int, default=250)
+    parser.add_argument("--members", type=int, default=200)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    module = load_cog_module()
+    # Saving is write-behind anyway, don't let it fire mid benchmark
+    module.SAVE_DELAY = 3600
+
+    rows = []
+    load_times = []
+    start_dir = os.getcwd()
+    for rules in args.sizes:
+        data_dir = tempfile.mkdtemp()
+        os.chdir(data_dir)
+        try:
+            size_rows, load_time = bench_size(module, rules, args,
+                                              random.Random(args.seed))
+        finally:
+            os.chdir(start_dir)
+            shutil.rmtree(data_dir)
+        rows.extend(size_rows)
+        load_times.append((rules, "{:.2f}".format(load_time * 1e3)))
+
+    print(tabulate(rows, headers=["Operation", "Rules", "Calls", "p50 us",
+                                  "p90 us", "p99 us", "Mean us", "Calls/s"],
+                   tablefmt="psql"))
+    print(tabulate(load_times, headers=["Rules", "Cog load ms"],
+                   tablefmt="psql"))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -5,10 +5,15 @@ from cogs.utils.dataIO import dataIO
 from cogs.utils import checks
 from cogs.utils.chat_formatting import box
 import os
+import io
+import json
 import logging
 import copy
+import collections
 import asyncio
+import threading
 import itertools
+import aiohttp
 
 try:
     from tabulate import tabulate
@@ -19,6 +24,19 @@ from __main__ import send_cmd_help, settings
 
 log = logging.getLogger("red.permissions")
 
+# Command wide locks, the rules themselves live in one file per server
+PERMS_PATH = "data/permissions/perms.json"
+SERVERS_PATH = "data/permissions/servers"
+PERMS_VERSION = 2
+# Servers kept in memory before the least recently used ones are dropped
+MAX_LOADED_SERVERS = 500
+# Longest a permission change can sit in memory before it's written out
+SAVE_DELAY = 5
+# Number of (command, channel, roles) results resolve_permission remembers
+DECISION_CACHE_SIZE = 4096
+# Table rows shown per page by p info and p audit
+PAGE_SIZE = 20
+
 
 class PermissionsError(CommandNotFound):
     """
@@ -54,19 +72,28 @@ class Check:
     This is what we're going to stick into the checks for Command objects
     """
 
-    def __init__(self, command):
+    def __init__(self, command, configured):
+        # Dot notation name of the command we're attached to
         self.command = command
+        # Shared with the cog, {server_id: commands with rules there}
+        self.configured = configured
 
     def __call__(self, ctx):
+        if ctx.message.channel.is_private:
+            return True
+        # Servers missing from configured haven't been looked at yet, those
+        #   go through the cog which indexes them.
+        commands = self.configured.get(ctx.message.server.id)
+        if commands is not None and self.command not in commands:
+            return True
+
         author = ctx.message.author
         perm_cog = ctx.bot.get_cog('Permissions')
         # Here we guarantee we're still loaded, if not, don't impede anything.
         if perm_cog is None or not hasattr(perm_cog, 'resolve_permission'):
             return True
-        elif ctx.message.channel.is_private:
-            return True
 
-        has_perm = perm_cog.resolve_permission(ctx)
+        has_perm = perm_cog.resolve_permission(ctx, self.command)
 
         if has_perm:
             log.debug("user {} allowed to execute {}"
@@ -88,6 +115,97 @@ class Check:
         return settings.owner
 
 
+class CompiledPermission:
+    """
+    Flattened, lookup-only view of perms_we_want[command][server] so that
+        resolve_permission doesn't have to walk the nested dicts, sort roles
+        or resolve the command on every invocation.
+    """
+
+    LOCK_GLOBAL = 1
+    LOCK_COG = 2
+    LOCK_SERVER = 4
+
+    __slots__ = ("denied_channels", "roles", "lock_mask", "locked_channels")
+
+    def __init__(self, denied_channels, roles, lock_mask, locked_channels):
+        self.denied_channels = denied_channels
+        # role id -> True (allow) / False (deny)
+        self.roles = roles
+        self.lock_mask = lock_mask
+        self.locked_channels = locked_channels
+
+    def is_locked(self, channel_id):
+        return bool(self.lock_mask) or channel_id in self.locked_channels
+
+    def resolve(self, channel_id, roles):
+        if self.is_locked(channel_id):
+            return False
+
+        # The highest positioned role with a rule wins, same as walking the
+        #   ordered role list from the top.
+        role_perm = None
+        top_position = -1
+        for role in roles:
+            verdict = self.roles.get(role.id)
+            if verdict is not None and role.position > top_position:
+                top_position = role.position
+                role_perm = verdict
+
+        if role_perm is not None:
+            return role_perm
+        return channel_id not in self.denied_channels
+
+
+class DecisionCache:
+    """
+    LRU of resolve_permission results keyed by
+        (command, server id, channel id, frozenset of role ids)
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        self._entries = collections.OrderedDict()
+        # {(command, server id): {keys}} so invalidation doesn't need a scan
+        self._index = {}
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        try:
+            verdict = self._entries[key]
+        except KeyError:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return verdict
+
+    def put(self, key, verdict):
+        self._entries[key] = verdict
+        self._index.setdefault(key[:2], set()).add(key)
+        if len(self._entries) > self.size:
+            oldest, _ = self._entries.popitem(last=False)
+            group = self._index[oldest[:2]]
+            group.discard(oldest)
+            if not group:
+                del self._index[oldest[:2]]
+
+    def invalidate(self, command=None, server_id=None):
+        if command is not None and server_id is not None:
+            groups = [(command, server_id)]
+        else:
+            groups = [g for g in self._index
+                      if command in (None, g[0]) and server_id in (None, g[1])]
+
+        for group in groups:
+            for key in self._index.pop(group, ()):
+                del self._entries[key]
+
+
 class Permissions:
     """
     The VERY important thing to note about this cog is that every command will
@@ -98,15 +216,68 @@ class Permissions:
     def __init__(self, bot):
         self.bot = bot
 
-        # All the saved permission levels with role ID's
-        self.perms_we_want = self._load_perms()
-        self.perm_lock = asyncio.Lock()
-
-        self.check_adder = bot.loop.create_task(self.add_checks_to_all())
+        # Command wide locks plus the rules of every loaded server:
+        #   {command: {"LOCKS": {"GLOBAL":, "COGS":}, server_id: {...}}}
+        self.perms_we_want = {}
+        # Server ids that have a file in SERVERS_PATH
+        self._stored_servers = set()
+        # Server ids whose rules are in perms_we_want, least recently used
+        #   first
+        self._loaded_servers = collections.OrderedDict()
+        # {server_id: commands with rules there}, for every server looked at
+        #   so far. Unlike perms_we_want this survives eviction.
+        self._configured = {}
+        self._load_perms()
+        # One lock per server, so edits on different servers never wait on
+        #   each other. Always take these with `async with`.
+        self._locks = collections.defaultdict(asyncio.Lock)
+
+        # Write-behind state for _save_perms
+        self._dirty = False
+        self._dirty_servers = set()
+        self._saving_servers = set()
+        self._saver = None
+        self._generation = 0
+        # {path: generation last written}
+        self._written_generations = {}
+        self._write_lock = threading.Lock()
+
+        # {command: {server_id: CompiledPermission or None}}
+        self._compiled = {}
+        self._decisions = DecisionCache(DECISION_CACHE_SIZE)
+
+        # {server_id: {role_id: rank}}, @everyone has rank 0
+        self._role_ranks = {}
+        # {server_id: {role_id: role}}
+        self._role_index = {}
+
+        # {dotted name: command object}, dropped whenever commands change
+        self._command_cache = {}
+        # {cog name: [top level command objects]}, built on first use
+        self._cog_commands = None
+
+        # discord.py doesn't dispatch anything when a cog gets (un)loaded so
+        #   we hook command registration to attach checks as commands arrive
+        #   and to keep the caches above honest.
+        self._original_add_command = bot.add_command
+        self._original_remove_command = bot.remove_command
+        bot.add_command = self._add_command_hook
+        bot.remove_command = self._remove_command_hook
+
+        self.add_checks_to_all()
 
     def __unload(self):
-        if self.check_adder:
-            self.check_adder.cancel()
+        if self.bot.add_command == self._add_command_hook:
+            self.bot.add_command = self._original_add_command
+        if self.bot.remove_command == self._remove_command_hook:
+            self.bot.remove_command = self._original_remove_command
+
+        if self._saver is not None:
+            self._saver.cancel()
+        if self._dirty:
+            self._dirty = False
+            self._write_perms(self._snapshot(
+                self._dirty_servers | self._saving_servers))
 
         for cmd_dot in self.perms_we_want:
             try:
@@ -119,26 +290,74 @@ class Permissions:
                 keepers = [c for c in cmd.checks if not isinstance(c, Check)]
                 cmd.checks = keepers
 
-    async def _check_perm_entry(self, command, server):
-        await self.perm_lock.acquire()
-        if command not in self.perms_we_want:
-            self.perms_we_want[command] = {"LOCKS": {"GLOBAL": False,
-                                                     "SERVERS": {},
-                                                     "CHANNELS": {}}}
-
-        if server.id not in self.perms_we_want[command]:
-            self.perms_we_want[command][server.id] = {"CHANNELS": {},
-                                                      "ROLES": {}}
-
-        if "LOCKS" not in self.perms_we_want[command]:
-            self.perms_we_want[command]["LOCKS"] = {"GLOBAL": False,
-                                                    "COGS": [],
-                                                    "SERVERS": {},
-                                                    "CHANNELS": {}}
-
-        if "COGS" not in self.perms_we_want[command]["LOCKS"]:
-            self.perms_we_want[command]["LOCKS"]["COGS"] = []
-        self.perm_lock.release()
+    def _check_perm_entry(self, command, server):
+        """Callers must hold the lock for server"""
+        self._load_server(server.id)
+        per_command = self._get_perm_command(command)
+        if server.id not in per_command:
+            per_command[server.id] = self._new_entry()
+        self._configured[server.id].add(command)
+        self._invalidate(command, server.id)
+
+        self._add_check(command)
+
+    def _clear_server(self, server):
+        """Callers must hold the lock for server"""
+        self._load_server(server.id)
+        for per_command in self.perms_we_want.values():
+            per_command.pop(server.id, None)
+        self._configured[server.id] = set()
+        self._invalidate(server_id=server.id)
+
+    def _add_check(self, cmd_dot, cmd_obj=None):
+        if cmd_obj is None:
+            try:
+                cmd_obj = self._get_command(cmd_dot)
+            except BadCommand:
+                # Command is no longer loaded/found
+                return
+
+        # Compare by name so checks left behind by a previous load of this
+        #   module are still recognised, and swapped for one of ours.
+        check_obj = discord.utils.find(
+            lambda c: type(c).__name__ == "Check", cmd_obj.checks)
+        if check_obj is not None:
+            if getattr(check_obj, "configured", None) is self._configured:
+                return
+            cmd_obj.checks.remove(check_obj)
+        log.debug("Check object not found in {},"
+                  " adding".format(cmd_dot))
+        cmd_obj.checks.append(Check(cmd_dot, self._configured))
+
+    def _add_command_hook(self, command):
+        self._original_add_command(command)
+        self._commands_changed()
+
+        for cmd_dot, cmd_obj in self._walk_command(command):
+            if cmd_dot in self.perms_we_want:
+                self._add_check(cmd_dot, cmd_obj)
+                self._invalidate(cmd_dot)
+
+    def _remove_command_hook(self, name):
+        command = self._original_remove_command(name)
+        self._commands_changed()
+
+        if command is not None:
+            for cmd_dot, _ in self._walk_command(command):
+                self._invalidate(cmd_dot)
+        return command
+
+    def _commands_changed(self):
+        self._command_cache.clear()
+        self._cog_commands = None
+
+    def _walk_command(self, command):
+        to_visit = [command]
+        while to_visit:
+            cmd_obj = to_visit.pop()
+            yield cmd_obj.qualified_name.replace(' ', '.'), cmd_obj
+            # Groups list aliases too, so the same object may come up twice
+            to_visit.extend(getattr(cmd_obj, "commands", {}).values())
 
     def _error_raise(exc):
         def deco(func):
@@ -170,29 +389,201 @@ class Permissions:
                                         " playlist.add instead of \"playlist"
                                         " add\")")
 
+    def _export_server(self, server):
+        """
+        Dumps everything set up for server, using channel and role names so
+            the result can be imported into another server as well. Names
+            shared by several channels or roles would end up as one key so
+            those are written as ids.
+        """
+        self._load_server(server.id)
+
+        def labels(objs, fold):
+            counts = collections.Counter(fold(o.name) for o in objs)
+            return {o.id: o.name if counts[fold(o.name)] == 1 else o.id
+                    for o in objs}
+
+        channels = labels(server.channels, str)
+        roles = labels(server.roles, str.lower)
+
+        def verdicts(perms, names):
+            return {names[objid]: "allow" if self._is_allow(status)
+                    else "deny"
+                    for objid, status in perms.items() if objid in names}
+
+        spec = {}
+        for cmd_dot, per_command in self.perms_we_want.items():
+            per_server = per_command.get(server.id)
+            if per_server is None:
+                continue
+
+            entry = {"channels": verdicts(per_server["CHANNELS"], channels),
+                     "roles": verdicts(per_server["ROLES"], roles)}
+            if per_server.get("LOCKED", False):
+                entry["locked"] = True
+            locked_channels = sorted(
+                channels[chanid] for chanid, locked
+                in per_server.get("LOCKED_CHANNELS", {}).items()
+                if locked and chanid in channels)
+            if locked_channels:
+                entry["locked_channels"] = locked_channels
+
+            if any(entry.values()):
+                spec[cmd_dot] = entry
+        return spec
+
+    def _compile(self, command, server_id):
+        per_command = self.perms_we_want.get(command)
+        if per_command is None or server_id not in per_command:
+            return None
+
+        per_server = per_command[server_id]
+        denied_channels = {chanid for chanid, status
+                           in per_server["CHANNELS"].items()
+                           if not self._is_allow(status)}
+        roles = {roleid: self._is_allow(status)
+                 for roleid, status in per_server["ROLES"].items()}
+
+        lock_mask = 0
+        locks = per_command["LOCKS"]
+        if locks["GLOBAL"]:
+            lock_mask |= CompiledPermission.LOCK_GLOBAL
+        if per_server.get("LOCKED", False):
+            lock_mask |= CompiledPermission.LOCK_SERVER
+        cog_locks = locks["COGS"]
+        if cog_locks and self._get_command(command).cog_name in cog_locks:
+            lock_mask |= CompiledPermission.LOCK_COG
+        locked_channels = frozenset(
+            chanid for chanid, locked
+            in per_server.get("LOCKED_CHANNELS", {}).items() if locked)
+
+        return CompiledPermission(denied_channels, roles, lock_mask,
+                                  locked_channels)
+
+    def _get_compiled(self, command, server):
+        if command not in self.perms_we_want:
+            return None
+
+        self._load_server(server.id)
+        per_command = self._compiled.setdefault(command, {})
+        try:
+            return per_command[server.id]
+        except KeyError:
+            compiled = self._compile(command, server.id)
+            per_command[server.id] = compiled
+            return compiled
+
+    def _invalidate(self, command=None, server_id=None):
+        """
+        Drops compiled entries and cached decisions so they get rebuilt on
+            next use. Leaving out command invalidates server_id across every
+            command, leaving out server_id invalidates every server for
+            command.
+        """
+        self._decisions.invalidate(command, server_id)
+        if command is None:
+            for per_command in self._compiled.values():
+                per_command.pop(server_id, None)
+        elif server_id is None:
+            self._compiled.pop(command, None)
+        else:
+            self._compiled.get(command, {}).pop(server_id, None)
+
     @_error_raise(BadCommand)
     def _get_command(self, cmd_string):
+        try:
+            return self._command_cache[cmd_string]
+        except KeyError:
+            pass
+
         cmd = cmd_string.split('.')
         ret = self.bot.commands[cmd.pop(0)]
         while len(cmd) > 0:
             ret = ret.commands[cmd.pop(0)]
+        self._command_cache[cmd_string] = ret
+        return ret
+
+    def _get_cog_commands(self, cog_name):
+        if self._cog_commands is None:
+            self._cog_commands = {}
+            seen = set()
+            for cmd in self.bot.commands.values():
+                # Aliases map to the same object
+                if id(cmd) in seen:
+                    continue
+                seen.add(id(cmd))
+                self._cog_commands.setdefault(cmd.cog_name, []).append(cmd)
+        return self._cog_commands.get(cog_name, [])
+
+    async def _get_audit(self, server):
+        """
+        Returns sorted (command, kind, name, status) rows covering every
+            permission set up on server.
+        """
+        rules = await self._copy_server_rules(server)
+        channels = {c.id: c for c in server.channels}
+        roles = self._get_role_index(server)
+
+        rows = []
+        for command, per_server in rules.items():
+            for chanid, status in per_server["CHANNELS"].items():
+                chan = channels.get(chanid)
+                if chan:
+                    allow_str = "Allowed" if self._is_allow(status) \
+                        else "Denied"
+                    rows.append((command, "Channel", chan.name, allow_str))
+
+            for roleid, status in per_server["ROLES"].items():
+                role = roles.get(roleid)
+                if role:
+                    allow_str = "Allowed" if self._is_allow(status) \
+                        else "Denied"
+                    rows.append((command, "Role", role.name, allow_str))
+
+            if per_server.get("LOCKED", False):
+                rows.append((command, "Server", server.name, "Locked"))
+            for chanid, locked in per_server.get("LOCKED_CHANNELS",
+                                                 {}).items():
+                chan = channels.get(chanid)
+                if chan and locked:
+                    rows.append((command, "Channel", chan.name, "Locked"))
+
+        rows.sort()
+        return rows
+
+    async def _copy_server_rules(self, server, command=None):
+        """
+        Copies server's rules (only command's if given) so they can be
+            looked through without holding the lock.
+        """
+        async with self._get_lock(server):
+            self._load_server(server.id)
+            ret = {}
+            for cmd, per_command in self.perms_we_want.items():
+                if command is not None and cmd != command:
+                    continue
+                per_server = per_command.get(server.id)
+                if per_server is not None:
+                    ret[cmd] = copy.deepcopy(per_server)
         return ret
 
     async def _get_info(self, server, command):
-        await self.perm_lock.acquire()
         command = command.qualified_name.replace(' ', '.')
 
-        per_server = self.perms_we_want[command][server.id]
+        per_server = (await self._copy_server_rules(server, command))[command]
+        channels = {c.id: c for c in server.channels}
+        roles = self._get_role_index(server)
+
         ret = {"CHANNELS": [], "ROLES": []}
         for chanid, status in per_server["CHANNELS"].items():
-            chan = self.bot.get_channel(chanid)
+            chan = channels.get(chanid)
             if chan:
                 allowed = self._is_allow(status)
                 allow_str = "Allowed" if allowed else "Denied"
                 ret["CHANNELS"].append((chan.name, allow_str))
 
         for roleid, status in per_server["ROLES"].items():
-            role = self._get_role_from_id(server, roleid)
+            role = roles.get(roleid)
             if role:
                 allowed = self._is_allow(status)
                 allow_str = "Allowed" if allowed else "Denied"
@@ -203,10 +594,18 @@ class Permissions:
 
         role_sort = sorted(ret["ROLES"], key=lambda r: r[0])
         ret["ROLES"] = role_sort
-        self.perm_lock.release()
 
         return ret
 
+    def _get_lock(self, server):
+        return self._locks[server.id]
+
+    def _get_perm_command(self, command):
+        if command not in self.perms_we_want:
+            self.perms_we_want[command] = {"LOCKS": {"GLOBAL": False,
+                                                     "COGS": []}}
+        return self.perms_we_want[command]
+
     def _get_ordered_role_list(self, server=None, roles=None):
         """
         First item in ordered list is @\u200Beveryone, e.g. the highest role
@@ -225,7 +624,24 @@ class Permissions:
         log.debug("Ordered roles for sid {}:\n\t{}".format(server.id,
                                                            ordered_roles))
 
-        return sorted(roles, key=lambda r: r.position)
+        return ordered_roles
+
+    def _get_role_index(self, server):
+        try:
+            return self._role_index[server.id]
+        except KeyError:
+            index = {role.id: role for role in server.roles}
+            self._role_index[server.id] = index
+            return index
+
+    def _get_role_ranks(self, server):
+        try:
+            return self._role_ranks[server.id]
+        except KeyError:
+            ordered_roles = self._get_ordered_role_list(server=server)
+            ranks = {role.id: rank for rank, role in enumerate(ordered_roles)}
+            self._role_ranks[server.id] = ranks
+            return ranks
 
     def _get_role(self, roles, role_string):
         if role_string.lower() == "everyone":
@@ -258,19 +674,14 @@ class Permissions:
         return discord.utils.get(self.bot.servers, id=serverid)
 
     def _has_higher_role(self, member, role):
-        server = member.server
-        roles = self._get_ordered_role_list(server=server)
+        ranks = self._get_role_ranks(member.server)
         try:
-            role_index = roles.index(role)
-        except ValueError:
+            role_rank = ranks[role.id]
+        except KeyError:
             # Role isn't in the ordered role list
             return False
 
-        higher_roles = roles[role_index + 1:]
-
-        if any([r in higher_roles for r in member.roles]):
-            return True
-        return False
+        return any(ranks.get(r.id, -1) > role_rank for r in member.roles)
 
     def _is_allow(self, permission):
         if permission.startswith("+"):
@@ -278,118 +689,356 @@ class Permissions:
         return False
 
     def _is_locked(self, command, server, channel):
-        locks = self.perms_we_want[command].get("LOCKS", None)
+        compiled = self._get_compiled(command, server)
 
-        if locks is None:
+        if compiled is None:
             return False
 
-        global_lock = locks["GLOBAL"]
-        server_lock = locks["SERVERS"].get(server.id, False)
-        channel_lock = locks["CHANNELS"].get(channel.id, False)
-
-        cog_name = self._get_command(command).cog_name
-        cog_lock = cog_name in locks.get("COGS", set())
-
-        return global_lock or cog_lock or server_lock or channel_lock
+        return compiled.is_locked(channel.id)
 
     def _load_perms(self):
+        if not os.path.exists(SERVERS_PATH):
+            os.makedirs(SERVERS_PATH)
         try:
-            ret = dataIO.load_json("data/permissions/perms.json")
+            ret = dataIO.load_json(PERMS_PATH)
         except:
-            ret = {}
-            if not os.path.exists("data/permissions"):
-                os.mkdir("data/permissions")
-            dataIO.save_json("data/permissions/perms.json", ret)
-        return ret
+            ret = {"VERSION": PERMS_VERSION, "LOCKS": {}}
+            dataIO.save_json(PERMS_PATH, ret)
 
-    async def _lock_channel(self, command, channel, lock=True):
-        await self._check_perm_entry(command, channel.server)
+        if "VERSION" not in ret:
+            ret = self._migrate_perms(ret)
+
+        for command, locks in ret["LOCKS"].items():
+            self.perms_we_want[command] = {"LOCKS": locks}
+        self._stored_servers = {fname[:-len(".json")]
+                                for fname in os.listdir(SERVERS_PATH)
+                                if fname.endswith(".json")}
+
+    def _load_server(self, server_id, shard=None):
+        """
+        Makes sure server_id's rules are in perms_we_want. Only the
+            MAX_LOADED_SERVERS most recently used servers are kept around.
+            shard is the server's file if the caller already read it.
+        """
+        if server_id in self._loaded_servers:
+            self._loaded_servers.move_to_end(server_id)
+            return
 
-        with (await self.perm_lock):
-            self.perms_we_want[command]["LOCKS"]["CHANNELS"][channel.id] = lock
+        commands = set()
+        if shard is None and server_id in self._stored_servers:
+            shard = dataIO.load_json(self._server_path(server_id))
+        if shard is not None:
+            for command, entry in shard.items():
+                self._get_perm_command(command)[server_id] = entry
+                commands.add(command)
+        self._configured[server_id] = commands
+        self._loaded_servers[server_id] = None
+
+        for cold_id in list(self._loaded_servers):
+            if len(self._loaded_servers) <= MAX_LOADED_SERVERS:
+                break
+            if cold_id == server_id or cold_id in self._dirty_servers or \
+                    cold_id in self._saving_servers or \
+                    (cold_id in self._locks and self._locks[cold_id].locked()):
+                continue
+            del self._loaded_servers[cold_id]
+            for per_command in self.perms_we_want.values():
+                per_command.pop(cold_id, None)
+            self._invalidate(server_id=cold_id)
 
-        self._save_perms()
+    async def _lock_channel(self, command, channel, lock=True):
+        server = channel.server
+        async with self._get_lock(server):
+            self._check_perm_entry(command, server)
+            per_server = self.perms_we_want[command][server.id]
+            per_server["LOCKED_CHANNELS"][channel.id] = lock
+            self._invalidate(command, server.id)
+
+        self._save_perms(server.id)
 
     async def _lock_cog(self, server, cogname, lock=True):
-        cmds = list(filter(lambda c: c.cog_name == cogname,
-                           self.bot.commands.values()))
+        cmds = self._get_cog_commands(cogname)
         for cmd_name in cmds:
             command = cmd_name.qualified_name.replace(" ", ".")
-            await self._check_perm_entry(command, server)
-            await self.perm_lock.acquire()
-            if lock:
-                if cogname not in \
-                        self.perms_we_want[command]["LOCKS"]["COGS"]:
-                    self.perms_we_want[command]["LOCKS"]["COGS"].append(
-                        cogname)
-            else:
-                try:
-                    self.perms_we_want[command]["LOCKS"]["COGS"].remove(
-                        cogname)
-                except Exception:
-                    # Cog wasn't locked
-                    pass
-            self.perm_lock.release()
+            async with self._get_lock(server):
+                self._check_perm_entry(command, server)
+                cog_locks = self.perms_we_want[command]["LOCKS"]["COGS"]
+                if lock:
+                    if cogname not in cog_locks:
+                        cog_locks.append(cogname)
+                else:
+                    try:
+                        cog_locks.remove(cogname)
+                    except ValueError:
+                        # Cog wasn't locked
+                        pass
+                self._invalidate(command)
 
-        self._save_perms()
+        self._save_perms(server.id)
 
     async def _lock_global(self, command, server, lock=True):
-        await self._check_perm_entry(command, server)
-
-        with (await self.perm_lock):
+        async with self._get_lock(server):
+            self._check_perm_entry(command, server)
             self.perms_we_want[command]["LOCKS"]["GLOBAL"] = lock
+            self._invalidate(command)
 
-        self._save_perms()
+        self._save_perms(server.id)
 
     async def _lock_server(self, command, server, lock=True):
-        await self._check_perm_entry(command, server)
+        async with self._get_lock(server):
+            self._check_perm_entry(command, server)
+            self.perms_we_want[command][server.id]["LOCKED"] = lock
+            self._invalidate(command, server.id)
 
-        with (await self.perm_lock):
-            self.perms_we_want[command]["LOCKS"]["SERVERS"][server.id] = lock
+        self._save_perms(server.id)
 
-        self._save_perms()
+    def _migrate_perms(self, legacy):
+        """
+        Splits the old single file layout into one file per server. Old
+            channel locks don't say which server they belong to so they're
+            copied to every server with rules for that command, `p prune`
+            drops the copies that don't belong.
+        """
+        log.info("Moving permissions to one file per server")
+        dataIO.save_json(PERMS_PATH + ".bak", legacy)
+
+        locks = {}
+        shards = {}
+        for command, per_command in legacy.items():
+            old_locks = per_command.get("LOCKS", {})
+            locks[command] = {"GLOBAL": old_locks.get("GLOBAL", False),
+                              "COGS": old_locks.get("COGS", [])}
+
+            server_locks = old_locks.get("SERVERS", {})
+            server_ids = set(per_command) | set(server_locks)
+            server_ids.discard("LOCKS")
+            for server_id in server_ids:
+                entry = self._new_entry()
+                entry.update(per_command.get(server_id, {}))
+                entry["LOCKED"] = server_locks.get(server_id, False)
+                entry["LOCKED_CHANNELS"] = dict(old_locks.get("CHANNELS", {}))
+                shards.setdefault(server_id, {})[command] = entry
+
+        for server_id, shard in shards.items():
+            dataIO.save_json(self._server_path(server_id), shard)
+
+        ret = {"VERSION": PERMS_VERSION, "LOCKS": locks}
+        dataIO.save_json(PERMS_PATH, ret)
+        return ret
 
-    async def _reset(self, server):
-        await self.perm_lock.acquire()
-        for cmd in self.perms_we_want:
-            try:
-                del self.perms_we_want[cmd][server.id]
-            except KeyError:
-                pass
+    def _new_entry(self):
+        return {"CHANNELS": {}, "ROLES": {}, "LOCKED": False,
+                "LOCKED_CHANNELS": {}}
+
+    def _paginate(self, rows, page):
+        """Returns (rows on page, page, page count), page is clamped"""
+        pages = max(1, (len(rows) + PAGE_SIZE - 1) // PAGE_SIZE)
+        page = min(max(page, 1), pages)
+        start = (page - 1) * PAGE_SIZE
+        return rows[start:start + PAGE_SIZE], page, pages
 
-            for chan in server.channels:
+    def _parse_spec(self, server, spec):
+        """
+        Validates an exported spec against server, resolving channel and
+            role names (or ids) up front. Returns (parsed, problems) and
+            nothing is applied unless problems comes back empty.
+        """
+        problems = []
+        parsed = {}
+
+        def get_channel(name):
+            chan = discord.utils.get(server.channels, id=name)
+            if chan is None:
+                named = [c for c in server.channels if c.name == name]
+                if len(named) > 1:
+                    problems.append("Several channels are named {}, use"
+                                    " the id instead".format(name))
+                elif named:
+                    chan = named[0]
+                else:
+                    problems.append("Unknown channel {}".format(name))
+            return chan
+
+        def get_role(name):
+            role = discord.utils.get(server.roles, id=name)
+            if role is None:
                 try:
-                    del self.perms_we_want[cmd]["LOCKS"]["CHANNELS"][chan.id]
-                except KeyError:
-                    pass
-        self.perm_lock.release()
-        self._save_perms()
+                    role = self._get_role(server.roles, name)
+                except RoleNotFound:
+                    problems.append("Unknown role {}".format(name))
+                    return None
+                if sum(r.name.lower() == role.name.lower()
+                       for r in server.roles) > 1:
+                    problems.append("Several roles are named {}, use the"
+                                    " id instead".format(name))
+                    return None
+            return role
+
+        def get_verdict(cmd_dot, status):
+            if status not in ("allow", "deny"):
+                problems.append("{}: \"{}\" should be allow or deny".format(
+                    cmd_dot, status))
+            return "+" if status == "allow" else "-"
+
+        if not isinstance(spec, dict):
+            return parsed, ["The spec must be a JSON object of commands"]
+
+        for cmd_dot, entry in spec.items():
+            if not isinstance(entry, dict):
+                problems.append("{} should map to an object".format(cmd_dot))
+                continue
+            try:
+                self._get_command(cmd_dot)
+            except BadCommand:
+                problems.append("Unknown command {}".format(cmd_dot))
+                continue
+
+            if not isinstance(entry.get("channels", {}), dict) or \
+                    not isinstance(entry.get("roles", {}), dict):
+                problems.append("{}: channels and roles should be objects"
+                                .format(cmd_dot))
+                continue
+            if not isinstance(entry.get("locked_channels", []), list):
+                problems.append("{}: locked_channels should be a list"
+                                .format(cmd_dot))
+                continue
+            if not isinstance(entry.get("locked", False), bool):
+                problems.append("{}: locked should be true or false"
+                                .format(cmd_dot))
+                continue
+
+            channels = {}
+            for name, status in entry.get("channels", {}).items():
+                chan = get_channel(name)
+                verdict = get_verdict(cmd_dot, status)
+                if chan is not None:
+                    channels[chan.id] = verdict + cmd_dot
+
+            roles = {}
+            for name, status in entry.get("roles", {}).items():
+                role = get_role(name)
+                verdict = get_verdict(cmd_dot, status)
+                if role is not None:
+                    roles[role.id] = verdict + cmd_dot
+
+            locked_channels = []
+            for name in entry.get("locked_channels", []):
+                chan = get_channel(name)
+                if chan is not None:
+                    locked_channels.append(chan.id)
+
+            parsed[cmd_dot] = {"CHANNELS": channels, "ROLES": roles,
+                               "LOCKED": entry.get("locked", False),
+                               "LOCKED_CHANNELS": locked_channels}
+        return parsed, problems
+
+    async def _import_server(self, server, parsed):
+        """Replaces everything set up for server in one go"""
+        async with self._get_lock(server):
+            self._clear_server(server)
+            for cmd_dot, entry in parsed.items():
+                self._check_perm_entry(cmd_dot, server)
+                per_server = self.perms_we_want[cmd_dot][server.id]
+                per_server["CHANNELS"].update(entry["CHANNELS"])
+                per_server["ROLES"].update(entry["ROLES"])
+                per_server["LOCKED"] = entry["LOCKED"]
+                for chanid in entry["LOCKED_CHANNELS"]:
+                    per_server["LOCKED_CHANNELS"][chanid] = True
+            self._invalidate(server_id=server.id)
+        self._save_perms(server.id)
+
+    async def _prune(self):
+        """
+        Drops servers the bot is no longer in, plus channels and roles that
+            no longer exist. Returns (servers dropped, rules dropped).
+        """
+        live_servers = {s.id: s for s in self.bot.servers}
+        servers_dropped = 0
+        rules_dropped = 0
+        for server_id in self._stored_servers | set(self._loaded_servers):
+            server = live_servers.get(server_id)
+            # The server may be gone so we can't go through _get_lock
+            async with self._locks[server_id]:
+                if server is None:
+                    for per_command in self.perms_we_want.values():
+                        per_command.pop(server_id, None)
+                    self._loaded_servers.pop(server_id, None)
+                    self._configured.pop(server_id, None)
+                    self._invalidate(server_id=server_id)
+                    servers_dropped += 1
+                    self._save_perms(server_id)
+                    continue
+
+                shard = None
+                if server_id not in self._loaded_servers:
+                    # Read away from the loop, and only kept in memory if
+                    #   there is something to drop
+                    shard = await self.bot.loop.run_in_executor(
+                        None, dataIO.load_json, self._server_path(server_id))
+                if server_id in self._loaded_servers:
+                    # Either it was loaded all along or it got loaded
+                    #   while the file was being read
+                    shard = {command: per_command[server_id]
+                             for command, per_command
+                             in self.perms_we_want.items()
+                             if server_id in per_command}
+
+                dropped = self._prune_shard(shard, server)
+                if dropped:
+                    rules_dropped += dropped
+                    self._load_server(server_id, shard)
+                    self._invalidate(server_id=server_id)
+                    self._save_perms(server_id)
+        return servers_dropped, rules_dropped
+
+    def _prune_shard(self, shard, server):
+        """
+        Drops the channels and roles server no longer has from shard's
+            entries, returns how many rules were dropped.
+        """
+        channel_ids = {c.id for c in server.channels}
+        role_ids = {r.id for r in server.roles}
+        dropped = 0
+        for per_server in shard.values():
+            for key, live_ids in (("CHANNELS", channel_ids),
+                                  ("ROLES", role_ids),
+                                  ("LOCKED_CHANNELS", channel_ids)):
+                rules = per_server.get(key, {})
+                for objid in [i for i in rules if i not in live_ids]:
+                    del rules[objid]
+                    dropped += 1
+        return dropped
+
+    async def _reset(self, server):
+        async with self._get_lock(server):
+            self._clear_server(server)
+        self._save_perms(server.id)
 
     async def _reset_channel(self, command, server, channel):
         try:
             command = command.qualified_name.replace(' ', '.')
         except AttributeError:
             # If we pass a cog name in as command
-            cmds = list(filter(lambda c: c.cog_name == command,
-                               self.bot.commands.values()))
+            cmds = self._get_cog_commands(command)
             for cmd in cmds:
                 await self._reset_channel(cmd, server, channel)
             return
-        if command not in self.perms_we_want:
-            return
+        async with self._get_lock(server):
+            self._load_server(server.id)
+            if command not in self.perms_we_want:
+                return
 
-        await self.perm_lock.acquire()
-        cmd_perms = self.perms_we_want[command]
-        if server.id not in cmd_perms:
-            return
+            cmd_perms = self.perms_we_want[command]
+            if server.id not in cmd_perms:
+                return
 
-        try:
-            del self.perms_we_want[command][server.id]["CHANNELS"][channel.id]
-        except KeyError:
-            pass
+            try:
+                del cmd_perms[server.id]["CHANNELS"][channel.id]
+            except KeyError:
+                pass
+            self._invalidate(command, server.id)
 
-        self.perm_lock.release()
-        self._save_perms()
+        self._save_perms(server.id)
 
     async def _reset_permission(self, command, server, channel=None,
                                 role=None):
@@ -403,101 +1052,131 @@ class Permissions:
             command = command.qualified_name.replace(' ', '.')
         except AttributeError:
             # If we pass a cog name in as command
-            cmds = list(filter(lambda c: c.cog_name == command,
-                               self.bot.commands.values()))
+            cmds = self._get_cog_commands(command)
             for cmd in cmds:
-                self._reset_role(cmd, server, role)
+                await self._reset_role(cmd, server, role)
             return
 
-        await self.perm_lock.acquire()
-        if command not in self.perms_we_want:
-            return
+        async with self._get_lock(server):
+            self._load_server(server.id)
+            if command not in self.perms_we_want:
+                return
 
-        cmd_perms = self.perms_we_want[command]
-        if server.id not in cmd_perms:
-            return
+            cmd_perms = self.perms_we_want[command]
+            if server.id not in cmd_perms:
+                return
 
-        try:
-            del self.perms_we_want[command][server.id]["ROLES"][role.id]
-        except KeyError:
-            pass
-        self.perm_lock.release()
+            try:
+                del cmd_perms[server.id]["ROLES"][role.id]
+            except KeyError:
+                pass
+            self._invalidate(command, server.id)
 
-        self._save_perms()
+        self._save_perms(server.id)
 
-    def resolve_permission(self, ctx):
-        command = ctx.command.qualified_name.replace(' ', '.')
+    def resolve_permission(self, ctx, command=None):
+        """command is the dot notation name, if the caller already has it"""
+        if command is None:
+            command = ctx.command.qualified_name.replace(' ', '.')
         server = ctx.message.server
         channel = ctx.message.channel
-        roles = reversed(self._get_ordered_role_list(
-            roles=ctx.message.author.roles))
-
-        try:
-            per_command = self.perms_we_want[command]
-        except KeyError:
-            log.debug("{} not in perms_we_want".format(command))
-            return True
 
-        try:
-            per_server = per_command[server.id]
-        except KeyError:
-            # In this case the server is not in the perms we want to check
-            #   therefore we're just gonna assume the default "allow"
-            log.debug("sid {} not found for command {}".format(server.id,
-                                                               command))
+        compiled = self._get_compiled(command, server)
+        if compiled is None:
+            # Either the command or this server has nothing set up, so
+            #   we assume the default "allow"
+            log.debug("no rules for {} in sid {}".format(command, server.id))
             return True
 
-        channel_perm_dict = per_server["CHANNELS"]
-        role_perm_dict = per_server["ROLES"]
-
-        if channel.id not in channel_perm_dict:
-            # Again, assume default "allow"
-            log.debug("chanid {} not found, chan_perm = True".format(
-                channel.id))
-            channel_perm = True
-        else:
-            # We know that an admin has set permission on this channel
-            if self._is_allow(channel_perm_dict[channel.id]):
-                log.debug("chanid {} found and allowed".format(channel.id))
-                channel_perm = True
-            else:
-                log.debug("chanid {} found and denied".format(channel.id))
-                channel_perm = False
-
-        for role in roles:
-            if role.id in role_perm_dict:
-                if self._is_allow(role_perm_dict[role.id]):
-                    log.debug("role {} found and allowed".format(role.id))
-                    role_perm = True
-                    break
-                else:
-                    log.debug("role {} found and denied".format(role.id))
-                    role_perm = False
-                    break
-        else:
-            # By doing this we let the channel perm override in the case of
-            #   no role perms being set.
-            log.debug("role not found, ignoring roles")
-            role_perm = None
-
-        is_locked = self._is_locked(command, server, channel)
-
-        has_perm = ((role_perm is None and channel_perm) or
-                    (role_perm is True)) and not is_locked
+        roles = ctx.message.author.roles
+        key = (command, server.id, channel.id,
+               frozenset(role.id for role in roles))
+        has_perm = self._decisions.get(key)
+        if has_perm is None:
+            has_perm = compiled.resolve(channel.id, roles)
+            self._decisions.put(key, has_perm)
         log.debug("uid {} has perm: {}".format(ctx.message.author.id,
                                                has_perm))
         return has_perm
 
-    def _save_perms(self):
-        dataIO.save_json('data/permissions/perms.json', self.perms_we_want)
+    def _save_perms(self, server_id):
+        """
+        Marks server_id's file (and the command wide locks) dirty, bursts of
+            changes within SAVE_DELAY seconds end up as a single write done
+            in the executor.
+        """
+        self._dirty = True
+        self._dirty_servers.add(server_id)
+        if self._saver is None or self._saver.done():
+            self._saver = self.bot.loop.create_task(self._delayed_save())
+
+    async def _delayed_save(self):
+        while self._dirty:
+            await asyncio.sleep(SAVE_DELAY)
+            self._dirty = False
+            # Servers being written can't be evicted until the write is done
+            self._saving_servers = self._dirty_servers
+            self._dirty_servers = set()
+            try:
+                await self.bot.loop.run_in_executor(
+                    None, self._write_perms,
+                    self._snapshot(self._saving_servers))
+            except Exception:
+                log.exception("Failed to save permissions, will retry")
+                self._dirty = True
+                self._dirty_servers |= self._saving_servers
+            finally:
+                self._saving_servers = set()
+
+    def _server_path(self, server_id):
+        return os.path.join(SERVERS_PATH, "{}.json".format(server_id))
+
+    def _snapshot(self, server_ids):
+        """
+        Returns (generation, {path: data}) for the locks file and every
+            server in server_ids, data is None for files to delete.
+        """
+        self._generation += 1
+        locks = {command: per_command["LOCKS"]
+                 for command, per_command in self.perms_we_want.items()}
+        files = {PERMS_PATH: {"VERSION": PERMS_VERSION, "LOCKS": locks}}
+
+        for server_id in server_ids:
+            shard = {command: per_command[server_id]
+                     for command, per_command in self.perms_we_want.items()
+                     if server_id in per_command}
+            if shard:
+                self._stored_servers.add(server_id)
+                files[self._server_path(server_id)] = shard
+            else:
+                self._stored_servers.discard(server_id)
+                files[self._server_path(server_id)] = None
+        return self._generation, copy.deepcopy(files)
+
+    def _write_perms(self, snapshot):
+        generation, files = snapshot
+        with self._write_lock:
+            for path, data in files.items():
+                # An older snapshot finishing late mustn't clobber a newer one
+                if generation < self._written_generations.get(path, 0):
+                    continue
+                if data is None:
+                    try:
+                        os.remove(path)
+                    except FileNotFoundError:
+                        pass
+                else:
+                    # dataIO writes to a temp file and renames it over the
+                    #   original
+                    dataIO.save_json(path, data)
+                self._written_generations[path] = generation
 
     async def _set_channel(self, command, server, channel, allow):
         try:
             cmd_dot_name = command.qualified_name.replace(" ", ".")
         except AttributeError:
             # If we pass a cog name in as command
-            cmds = list(filter(lambda c: c.cog_name == command,
-                               self.bot.commands.values()))
+            cmds = self._get_cog_commands(command)
             for cmd in cmds:
                 await self._set_channel(cmd, server, channel, allow)
             return
@@ -507,16 +1186,12 @@ class Permissions:
         else:
             allow = "-"
 
-        await self.perm_lock.acquire()
-        if cmd_dot_name not in self.perms_we_want:
-            self.perms_we_want[cmd_dot_name] = {}
-        if server.id not in self.perms_we_want[cmd_dot_name]:
-            self.perms_we_want[cmd_dot_name][server.id] = \
-                {"CHANNELS": {}, "ROLES": {}}
-        self.perms_we_want[cmd_dot_name][server.id]["CHANNELS"][channel.id] = \
-            "{}{}".format(allow, cmd_dot_name)
-        self.perm_lock.release()
-        self._save_perms()
+        async with self._get_lock(server):
+            self._check_perm_entry(cmd_dot_name, server)
+            channels = self.perms_we_want[cmd_dot_name][server.id]["CHANNELS"]
+            channels[channel.id] = "{}{}".format(allow, cmd_dot_name)
+            self._invalidate(cmd_dot_name, server.id)
+        self._save_perms(server.id)
 
     async def _set_permission(self, command, server, channel=None, role=None,
                               allow=True):
@@ -532,8 +1207,7 @@ class Permissions:
             cmd_dot_name = command.qualified_name.replace(" ", ".")
         except AttributeError:
             # If we pass a cog name in as command
-            cmds = list(filter(lambda c: c.cog_name == command,
-                               self.bot.commands.values()))
+            cmds = self._get_cog_commands(command)
             for cmd in cmds:
                 await self._set_role(cmd, server, role, allow)
         else:
@@ -541,16 +1215,12 @@ class Permissions:
                 allow = "+"
             else:
                 allow = "-"
-            await self.perm_lock.acquire()
-            if cmd_dot_name not in self.perms_we_want:
-                self.perms_we_want[cmd_dot_name] = {}
-            if server.id not in self.perms_we_want[cmd_dot_name]:
-                self.perms_we_want[cmd_dot_name][server.id] = \
-                    {"CHANNELS": {}, "ROLES": {}}
-            self.perms_we_want[cmd_dot_name][server.id]["ROLES"][role.id] = \
-                "{}{}".format(allow, cmd_dot_name)
-            self.perm_lock.release()
-            self._save_perms()
+            async with self._get_lock(server):
+                self._check_perm_entry(cmd_dot_name, server)
+                roles = self.perms_we_want[cmd_dot_name][server.id]["ROLES"]
+                roles[role.id] = "{}{}".format(allow, cmd_dot_name)
+                self._invalidate(cmd_dot_name, server.id)
+            self._save_perms(server.id)
 
     @commands.group(pass_context=True, no_pm=True)
     @checks.serverowner_or_permissions(manage_roles=True)
@@ -630,11 +1300,80 @@ class Permissions:
         await self.bot.say("Channel {} permissions for {} reset.".format(
             channel.mention, command))
 
+    @p.command(pass_context=True, name="export")
+    async def p_export(self, ctx):
+        """Uploads every permission on this server as a JSON file
+
+        The file can be fed back to `p import` here or on another server."""
+        server = ctx.message.server
+        async with self._get_lock(server):
+            spec = self._export_server(server)
+
+        data = json.dumps(spec, indent=4, sort_keys=True).encode("utf-8")
+        await self.bot.upload(io.BytesIO(data),
+                              filename="permissions-{}.json".format(server.id))
+
+    @p.command(pass_context=True, name="import")
+    async def p_import(self, ctx, *, spec=None):
+        """Replaces ALL permissions on this server with an exported spec
+
+        Attach the file made by `p export` or paste its contents."""
+        server = ctx.message.server
+        if ctx.message.attachments:
+            url = ctx.message.attachments[0]["url"]
+            try:
+                with aiohttp.ClientSession() as session:
+                    async with session.get(url) as resp:
+                        spec = await resp.text()
+            except Exception:
+                log.exception("Failed downloading spec from {}".format(url))
+                await self.bot.say("Couldn't download that file.")
+                return
+        elif spec is None:
+            await send_cmd_help(ctx)
+            return
+
+        spec = spec.strip("` \n")
+        if spec.startswith("json"):
+            # Pasted as a ```json code block
+            spec = spec[len("json"):]
+        try:
+            spec = json.loads(spec)
+        except ValueError:
+            await self.bot.say("That isn't valid JSON.")
+            return
+
+        parsed, problems = self._parse_spec(server, spec)
+        if problems:
+            await self.bot.say("Nothing was imported:\n" +
+                               box("\n".join(problems[:20])))
+            return
+
+        await self._import_server(server, parsed)
+        await self.bot.say("Imported permissions for {} commands.".format(
+            len(parsed)))
+
+    @p.command(pass_context=True)
+    async def audit(self, ctx, page: int=1):
+        """Lists every permission set up on your server, a page at a time"""
+        server = ctx.message.server
+        rows = await self._get_audit(server)
+        if not rows:
+            await self.bot.say("No permissions have been set up for this"
+                               " server.")
+            return
+
+        rows, page, pages = self._paginate(rows, page)
+        msg = tabulate(rows, headers=["Command", "Type", "Name", "Status"],
+                       tablefmt='psql')
+        await self.bot.say(box("{}\nPage {}/{}".format(msg, page, pages)))
+
     @p.command(pass_context=True)
-    async def info(self, ctx, command):
+    async def info(self, ctx, command, page: int=1):
         """Gives current info about permissions on your server"""
         server = ctx.message.server
         channel = ctx.message.channel
+        self._load_server(server.id)
         if command not in self.perms_we_want:
             await self.bot.say("No permissions have been set up for that"
                                " command")
@@ -661,7 +1400,10 @@ class Permissions:
                 locked = tuple()
             data.append(row[0] + row[1] + locked)
 
+        data, page, pages = self._paginate(data, page)
         msg = tabulate(data, headers=headers, tablefmt='psql')
+        if pages > 1:
+            msg += "\nPage {}/{}".format(page, pages)
         await self.bot.say(box(msg))
 
     @p.group(pass_context=True, invoke_without_command=True)
@@ -723,6 +1465,17 @@ class Permissions:
         await self._lock_server(command, server)
         await self.bot.say("Server locked {}".format(command))
 
+    @p.command(pass_context=True, name="prune")
+    async def p_prune(self, ctx):
+        """Drops permissions for servers, channels and roles that are gone"""
+        author = ctx.message.author
+        if author.id != self.bot.settings.owner:
+            return
+
+        servers, rules = await self._prune()
+        await self.bot.say("Pruned {} servers and {} rules.".format(servers,
+                                                                    rules))
+
     @p.command(pass_context=True, name="reset")
     async def p_reset(self, ctx):
         """Resets ALL permissions on this server"""
@@ -798,6 +1551,26 @@ class Permissions:
 
         await self.bot.say("{} permission reset.".format(role.name))
 
+    @p.command(name="stats")
+    async def p_stats(self):
+        """Shows how well the permission decision cache is doing"""
+        cache = self._decisions
+        lookups = cache.hits + cache.misses
+        hit_rate = cache.hits / lookups * 100 if lookups else 0
+
+        msg = ("Cached decisions: {}/{}\n"
+               "Hits:   {}\n"
+               "Misses: {}\n"
+               "Hit rate: {:.1f}%").format(len(cache), cache.size, cache.hits,
+                                          cache.misses, hit_rate)
+        await self.bot.say(box(msg))
+
+    @p.command(name="sync")
+    async def p_sync(self):
+        """Re-attaches permission checks to every configured command"""
+        self.add_checks_to_all()
+        await self.bot.say("Permission checks synced.")
+
     @p.group(pass_context=True, invoke_without_command=True)
     async def unlock(self, ctx, command):
         """Globally unlocks a command from being used by anyone but owner
@@ -855,32 +1628,42 @@ class Permissions:
         await self._lock_server(command, server, False)
         await self.bot.say("Server unlocked {}".format(command))
 
+    # add_cog registers on_* methods as listeners and remove_cog drops them,
+    #   so an unloaded instance doesn't keep receiving events.
+    async def on_server_role_create(self, role):
+        self._roles_changed(role.server)
+
+    async def on_server_role_delete(self, role):
+        self._roles_changed(role.server)
+
+    async def on_server_role_update(self, before, after):
+        self._roles_changed(after.server)
+
+    def _roles_changed(self, server):
+        # Creating, deleting or moving one role can shift every other role's
+        #   position so the whole server gets re-ranked on next use.
+        self._role_ranks.pop(server.id, None)
+        self._role_index.pop(server.id, None)
+        self._decisions.invalidate(server_id=server.id)
+
+    async def on_channel_delete(self, channel):
+        if channel.is_private:
+            return
+        self._decisions.invalidate(server_id=channel.server.id)
+
     async def command_error(self, error, ctx):
         cmd = ctx.command
         if cmd and cmd.qualified_name.split(" ")[0] == "p":
             await self._error_responses(error, ctx)
 
-    async def add_checks_to_all(self):
-        while self == self.bot.get_cog('Permissions'):
-            perms_we_want = copy.copy(self.perms_we_want)
-            for cmd_dot in perms_we_want:
-                try:
-                    cmd_obj = self._get_command(cmd_dot)
-                    check_obj = discord.utils.find(
-                        lambda c: type(c).__name__ == "Check", cmd_obj.checks)
-                except BadCommand:
-                    # Command is no longer loaded/found
-                    pass
-                except AttributeError:
-                    # cmd_obj got to be None somehow so we'll assume it's not
-                    #   loaded
-                    pass
-                else:
-                    if check_obj is None:
-                        log.debug("Check object not found in {},"
-                                  " adding".format(cmd_dot))
-                        cmd_obj.checks.append(Check(cmd_dot))
-            await asyncio.sleep(0.5)
+    def add_checks_to_all(self):
+        """
+        Reconciliation sweep, new commands and new permission entries get
+            their checks as they show up so this only needs to run on load
+            or when asked to.
+        """
+        for cmd_dot in list(self.perms_we_want):
+            self._add_check(cmd_dot)
 
 
 def setup(bot):
@@ -0,0 +1,326 @@
+"""
+Benchmarks the RSS cog's poll cycle without touching the network.
+
+Run it from the root of your Red install (so `cogs.utils` can be imported):
+
+    python3 path/to/rss/bench_rss.py --feeds 10 100 500 --subscribers 5
+
+A local aiohttp server, in its own process so its CPU time isn't counted,
+serves generated RSS and Atom documents. Between cycles a share of the feeds
+(--changing) gets --churn new entries, the others answer 304 Not Modified.
+Every size subscribes --subscribers channels of a fake bot to each feed and
+times full poll cycles: fetch, parse, fan-out and draining the post queue.
+"""
+import argparse
+import asyncio
+import gc
+import importlib.util
+import multiprocessing
+import os
+import random
+import resource
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+from types import SimpleNamespace
+
+from aiohttp import web
+from tabulate import tabulate
+
+
+# rss.py does `from __main__ import send_cmd_help`, so this script has to
+#   provide it before the cog gets imported.
+async def send_cmd_help(ctx):
+    pass
+
+
+EPOCH = 1500000000
+ENTRY_GAP = 60
+LOREM = "Lorem ipsum dolor sit amet, consectetur adipiscing elit. "
+
+
+class FeedServer:
+    """Serves /feed/<n>.xml, every feed keeps its own version"""
+
+    def __init__(self, args):
+        self.args = args
+        self.rng = random.Random(args.seed)
+        self.versions = {}
+
+    def is_atom(self, feed):
+        return feed % 100 < self.args.atom * 100
+
+    def next_cycle(self):
+        for feed in self.versions:
+            if self.rng.random() < self.args.changing:
+                self.versions[feed] += self.args.churn
+
+    def document(self, feed, version):
+        newest = version + self.args.entries
+        indexes = range(newest - 1, version - 1, -1)
+        padding = (LOREM * (self.args.entry_size // len(LOREM) + 1))[
+            :self.args.entry_size]
+        if self.is_atom(feed):
+            return self.atom(feed, indexes, padding)
+        return self.rss(feed, indexes, padding)
+
+    @staticmethod
+    def rss(feed, indexes, padding):
+        items = "".join(
+            "<item><title>Feed {0} entry {1}</title>"
+            "<link>http://example.com/{0}/{1}</link>"
+            "<guid>feed-{0}-{1}</guid><pubDate>{2}</pubDate>"
+            "<description>{3}</description></item>".format(
+                feed, i, time.strftime("%a, %d %b %Y %H:%M:%S +0000",
+                                       time.gmtime(EPOCH + i * ENTRY_GAP)),
+                padding)
+            for i in indexes)
+        return ("<?xml version='1.0' encoding='utf-8'?><rss version='2.0'>"
+                "<channel><title>Feed {}</title><link>http://example.com"
+                "</link><description>Benchmark</description>{}</channel>"
+                "</rss>".format(feed, items))
+
+    @staticmethod
+    def atom(feed, indexes, padding):
+        entries = "".join(
+            "<entry><title>Feed {0} entry {1}</title>"
+            "<link href='http://example.com/{0}/{1}'/>"
+            "<id>feed-{0}-{1}</id><updated>{2}</updated>"
+            "<summary>{3}</summary></entry>".format(
+                feed, i, time.strftime("%Y-%m-%dT%H:%M:%SZ",
+                                       time.gmtime(EPOCH + i * ENTRY_GAP)),
+                padding)
+            for i in indexes)
+        return ("<?xml version='1.0' encoding='utf-8'?>"
+                "<feed xmlns='http://www.w3.org/2005/Atom'>"
+                "<title>Feed {}</title><id>feed-{}</id><updated>{}</updated>"
+                "{}</feed>".format(feed, feed, time.strftime(
+                    "%Y-%m-%dT%H:%M:%SZ", time.gmtime(EPOCH)), entries))
+
+    async def handle_feed(self, request):
+        feed = int(request.match_info["feed"])
+        version = self.versions.setdefault(feed, 0)
+        etag = '"{}"'.format(version)
+        if request.headers.get("If-None-Match") == etag:
+            return web.Response(status=304, headers={"ETag": etag})
+
+        response = web.Response(
+            body=self.document(feed, version).encode("utf-8"),
+            content_type="application/rss+xml", headers={"ETag": etag})
+        if self.args.gzip:
+            response.enable_compression()
+        return response
+
+    async def handle_cycle(self, request):
+        self.next_cycle()
+        return web.Response(text="ok")
+
+    async def handle_reset(self, request):
+        self.rng = random.Random(self.args.seed)
+        self.versions.clear()
+        return web.Response(text="ok")
+
+
+def serve(args, port_queue):
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+
+    server = FeedServer(args)
+    app = web.Application()
+    app.router.add_route("GET", "/feed/{feed}.xml", server.handle_feed)
+    app.router.add_route("GET", "/_cycle", server.handle_cycle)
+    app.router.add_route("GET", "/_reset", server.handle_reset)
+
+    handler = app.make_handler(access_log=None)
+    srv = loop.run_until_complete(
+        loop.create_server(handler, "127.0.0.1", 0))
+    port_queue.put(srv.sockets[0].getsockname()[1])
+    loop.run_forever()
+
+
+class FakeChannel:
+    def __init__(self, channel_id, server):
+        self.id = channel_id
+        self.server = server
+
+    def permissions_for(self, member):
+        return SimpleNamespace(send_messages=True)
+
+
+class FakeBot:
+    def __init__(self, loop):
+        self.loop = loop
+        self.cogs = {}
+        self.channels = {}
+        self.sent = 0
+
+    def get_channel(self, channel_id):
+        return self.channels.get(channel_id)
+
+    def get_cog(self, name):
+        return self.cogs.get(name)
+
+    async def send_message(self, channel, message):
+        self.sent += 1
+
+    async def wait_until_ready(self):
+        pass
+
+
+def load_cog_module():
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        "rss.py")
+    spec = importlib.util.spec_from_file_location("rss", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def subscribe(cog, bot, base_url, feeds, subscribers):
+    # add_feed saves feeds.json every time, save once at the end instead
+    save_feeds = cog.feeds.save_feeds
+    cog.feeds.save_feeds = lambda: None
+    for s in range(subscribers):
+        server = SimpleNamespace(id="1{:05d}".format(s),
+                                 me=SimpleNamespace(id="0"))
+        channel = FakeChannel("2{:05d}".format(s), server)
+        bot.channels[channel.id] = channel
+        for f in range(feeds):
+            cog.feeds.add_feed(server.id, channel.id, "feed{}".format(f),
+                               "{}/feed/{}.xml".format(base_url, f),
+                               None, None)
+    cog.feeds.save_feeds = save_feeds
+    cog.feeds.save_feeds()
+
+
+async def server_get(session, url):
+    async with session.get(url) as resp:
+        await resp.read()
+
+
+async def run_cycle(cog, bot):
+    all_feeds = cog.feeds.get_copy()
+    sent = bot.sent
+    await cog.poll_feeds(all_feeds, list(all_feeds))
+    await cog.posts.join()
+    await cog.feeds.flush(bot.loop)
+    return bot.sent - sent
+
+
+def bench_size(module, feeds, args, base_url):
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+
+    bot = FakeBot(loop)
+    cog = module.RSS(bot)
+    bot.cogs["RSS"] = cog
+    if not args.rate_limits:
+        cog.settings.channel_sends = 10 ** 9
+        cog.settings.global_sends_per_second = 10 ** 9
+        cog.posts = module.PostQueue(bot, cog.settings)
+    subscribe(cog, bot, base_url, feeds, args.subscribers)
+
+    loop.run_until_complete(server_get(cog.session, base_url + "/_reset"))
+    # The first cycle downloads and parses everything and sets the cursors
+    loop.run_until_complete(run_cycle(cog, bot))
+
+    walls = []
+    cpus = []
+    posts = 0
+    received = sum(m["bytes"] for m in cog.metrics.feeds.values())
+    if args.trace_memory:
+        tracemalloc.start()
+    for _ in range(args.cycles):
+        loop.run_until_complete(server_get(cog.session,
+                                           base_url + "/_cycle"))
+        gc.collect()
+        cpu = time.process_time()
+        t0 = time.perf_counter()
+        posts += loop.run_until_complete(run_cycle(cog, bot))
+        walls.append(time.perf_counter() - t0)
+        cpus.append(time.process_time() - cpu)
+    peak = None
+    if args.trace_memory:
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    received = sum(m["bytes"] for m in cog.metrics.feeds.values()) - received
+
+    cog._RSS__unload()
+    loop.run_until_complete(asyncio.sleep(0))
+    loop.close()
+
+    walls.sort()
+    total = sum(walls)
+    return [feeds, feeds * args.subscribers, args.cycles,
+            "{:.1f}".format(walls[len(walls) // 2] * 1e3),
+            "{:.1f}".format(walls[min(len(walls) - 1,
+                                      int(len(walls) * 0.9))] * 1e3),
+            "{:.1f}".format(statistics.mean(walls) * 1e3),
+            "{:.1f}".format(statistics.mean(cpus) * 1e3),
+            "{:,.0f}".format(posts / total if total else 0),
+            "{:,.0f}".format(received / args.cycles / 1024),
+            "-" if peak is None else "{:.1f}".format(peak / 2 ** 20)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--feeds", type=int, nargs="+", default=[10, 100, 500],
+                        help="number of feed URLs in each run")
+    parser.add_argument("--subscribers", type=int, default=5,
+                        help="channels subscribed to every feed")
+    parser.add_argument("--cycles", type=int, default=10,
+                        help="poll cycles timed per run")
+    parser.add_argument("--entries", type=int, default=20,
+                        help="entries in every document")
+    parser.add_argument("--entry-size", type=int, default=500,
+                        help="bytes of text in every entry")
+    parser.add_argument("--churn", type=int, default=2,
+                        help="new entries when a feed changes")
+    parser.add_argument("--changing", type=float, default=0.3,
+                        help="share of the feeds changing every cycle")
+    parser.add_argument("--atom", type=float, default=0.5,
+                        help="share of the feeds served as Atom")
+    parser.add_argument("--gzip", action="store_true",
+                        help="compress the documents")
+    parser.add_argument("--rate-limits", action="store_true",
+                        help="keep the cog's send budgets")
+    parser.add_argument("--trace-memory", action="store_true",
+                        help="report the peak traced memory (slower)")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    port_queue = multiprocessing.Queue()
+    server = multiprocessing.Process(target=serve, args=(args, port_queue),
+                                     daemon=True)
+    server.start()
+    base_url = "http://127.0.0.1:{}".format(port_queue.get(timeout=30))
+
+    module = load_cog_module()
+
+    rows = []
+    start_dir = os.getcwd()
+    try:
+        for feeds in args.feeds:
+            data_dir = tempfile.mkdtemp()
+            os.chdir(data_dir)
+            try:
+                rows.append(bench_size(module, feeds, args, base_url))
+            finally:
+                os.chdir(start_dir)
+                shutil.rmtree(data_dir)
+    finally:
+        server.terminate()
+
+    print(tabulate(rows, headers=["Feeds", "Subs", "Cycles", "p50 ms",
+                                  "p90 ms", "Mean ms", "CPU ms", "Posts/s",
+                                  "KB/cycle", "Peak MB"],
+                   tablefmt="psql"))
+    print("Max RSS: {:.1f} MB".format(
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
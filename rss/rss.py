@@ -6,10 +6,21 @@ import asyncio
 import string
 import logging
 import copy
+import calendar
+import functools
+import hashlib
+import heapq
+import random
+import re
+import time
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from email.utils import mktime_tz, parsedate_tz
+from urllib.parse import urlparse
 
 from cogs.utils import checks
-from cogs.utils.dataIO import fileIO
+from cogs.utils.dataIO import dataIO, fileIO
 from cogs.utils.chat_formatting import *
 from __main__ import send_cmd_help
 
@@ -22,10 +33,427 @@ log = logging.getLogger("red.rss")
 
 
 MAX_UPDATES = 10
+MAX_MESSAGE_LENGTH = 2000
+FEEDS_PATH = "data/RSS/feeds.json"
+STATE_PATH = "data/RSS/state.json"
+VALIDATORS_PATH = "data/RSS/validators.json"
+METRICS_PATH = "data/RSS/metrics.json"
+# Feeds listed under each heading of `rss stats`
+STATS_TOP = 5
+# Characters of a feed's last error kept for `rss stats`
+MAX_ERROR_LENGTH = 100
+# Per feed keys that change on every post, kept in state.json
+STATE_KEYS = ('last_update', 'update_time', 'seen')
+# Posted entries remembered per feed, and for how long (seconds)
+SEEN_LIMIT = 200
+SEEN_MAX_AGE = 30 * 24 * 3600
+READ_CHUNK = 16384
+# Seconds an idle connection is kept open for the next poll
+KEEPALIVE_TIMEOUT = 60
+# Anything feedparser could turn into entries starts with one of these
+XML_BOMS = (b'\xef\xbb\xbf', b'\xff\xfe', b'\xfe\xff')
+# Longest the update loop sleeps, so new feeds and unloads are noticed
+SCHEDULER_TICK = 30
+MAX_AGE_RE = re.compile(r'max-age=(\d+)')
+# ISO 8601 timezone offsets, "+01:00" is turned into "+0100" for strptime
+ISO_OFFSET_RE = re.compile(r'([+-]\d\d):(\d\d)$')
+# Kinds of term in a keyword filter
+TERM_WORD = 0
+TERM_PREFIX = 1
+TERM_REGEX = 2
+# Keyword syntax of new subscriptions. Subscriptions saved without a
+#  filter_syntax have syntax 1, where the keyword is a plain substring.
+FILTER_SYNTAX = 2
+# Distinct words a tag needs, over all of a URL's subscriptions, before
+#  they are searched for with one Aho-Corasick pass instead of one by one
+COMBINED_FILTER_MIN = 128
+ISO_FORMATS = ('%Y-%m-%dT%H:%M:%S%z', '%Y-%m-%dT%H:%M:%S.%f%z',
+               '%Y-%m-%d %H:%M:%S%z', '%Y-%m-%d%z')
 
 
 class Settings(object):
-    pass
+    """ Tunables, any of them can be overridden in data/RSS/settings.json """
+
+    defaults = {
+        # Feeds downloaded at the same time, overall and per host
+        'max_fetches': 20,
+        'max_fetches_per_host': 4,
+        # Seconds before a single feed download is abandoned
+        'fetch_timeout': 30,
+        # Bytes, bigger documents are dropped without being parsed
+        'max_feed_size': 2 * 1024 * 1024,
+        # Threads feedparser runs in, away from the event loop
+        'parse_workers': 2,
+        # Seconds between polls of the same feed. Each feed starts at
+        #  poll_interval and moves between the bounds depending on how
+        #  often it publishes.
+        'poll_interval': 300,
+        'min_poll_interval': 120,
+        'max_poll_interval': 3600,
+        # Longest a failing feed is left alone
+        'max_backoff': 6 * 3600,
+        # Fraction of every interval that is randomized
+        'poll_jitter': 0.1,
+        # Posts sent to one channel per window (seconds), and to all of
+        #  them per second
+        'channel_sends': 5,
+        'channel_send_window': 5,
+        'global_sends_per_second': 20,
+        # Join posts waiting for the same channel into one message
+        'merge_posts': False,
+        # Seconds between dumps of the poll metrics to metrics.json,
+        #  0 to never write them
+        'metrics_interval': 0
+    }
+
+    def __init__(self):
+        f = "data/RSS/settings.json"
+        overrides = fileIO(f, "load") if fileIO(f, "check") else {}
+
+        for key, value in self.defaults.items():
+            setattr(self, key, overrides.get(key, value))
+
+
+class Scheduler(object):
+    """ Keeps a queue of feed URLs ordered by when they are next due.
+
+        Every fetch reports back through fetched() or failed(), which pick
+        the feed's next poll from what it publishes and what the server
+        asks for (ttl, Cache-Control, Retry-After).
+    """
+
+    def __init__(self, settings):
+        self.settings = settings
+
+        # [(due, url)], stale items are skipped when popped
+        self._queue = []
+        # { URL: {due:, interval:, errors:} }
+        self._state = {}
+
+    def sync(self, urls):
+        """ Starts tracking new URLs and forgets removed ones. """
+        for url in list(self._state):
+            if url not in urls:
+                del self._state[url]
+
+        now = time.time()
+        for url in urls:
+            if url not in self._state:
+                self._state[url] = {
+                    'interval': self.settings.poll_interval,
+                    'errors': 0
+                }
+                # Spread a burst of new feeds over the first tick
+                self._push(url, now + random.uniform(
+                    0, min(SCHEDULER_TICK, self.settings.poll_interval)))
+
+    def pop_due(self, now=None):
+        now = time.time() if now is None else now
+        due = []
+        while self._queue and self._queue[0][0] <= now:
+            when, url = heapq.heappop(self._queue)
+            state = self._state.get(url)
+            if state is not None and state['due'] == when:
+                state['due'] = None
+                due.append(url)
+        return due
+
+    def next_due(self):
+        while self._queue:
+            when, url = self._queue[0]
+            state = self._state.get(url)
+            if state is not None and state['due'] == when:
+                return when
+            heapq.heappop(self._queue)
+        return None
+
+    def get_interval(self, url):
+        state = self._state.get(url)
+        return state['interval'] if state else None
+
+    def fetched(self, url, headers=None, ttl=None, entries=None):
+        """ Reschedules a feed after a successful poll. Without entries the
+            feed wasn't modified, so it is polled a little less often.
+        """
+        state = self._state.get(url)
+        if state is None:
+            return
+        settings = self.settings
+        state['errors'] = 0
+
+        interval = state['interval']
+        if entries is None:
+            interval *= 1.25
+        else:
+            period = self.publish_period(entries)
+            if period is not None:
+                # Halfway between the old interval and half the period
+                interval = (interval + period / 2) / 2
+
+        # The feed (or server) asking not to be polled more often than this
+        floor = settings.min_poll_interval
+        if ttl is not None and str(ttl).isdigit():
+            floor = max(floor, int(ttl) * 60)
+        if headers:
+            max_age = MAX_AGE_RE.search(headers.get('Cache-Control', ''))
+            if max_age:
+                floor = max(floor, int(max_age.group(1)))
+
+        interval = min(max(interval, floor), settings.max_poll_interval)
+        state['interval'] = interval
+        self._push(url, self._jittered(time.time(), interval, headers))
+
+    def failed(self, url, headers=None):
+        """ Backs off exponentially while a feed keeps failing. """
+        state = self._state.get(url)
+        if state is None:
+            return
+        state['errors'] += 1
+        delay = min(state['interval'] * 2 ** state['errors'],
+                    self.settings.max_backoff)
+        self._push(url, self._jittered(time.time(), delay, headers))
+
+    def _jittered(self, now, delay, headers):
+        jitter = self.settings.poll_jitter
+        due = now + delay * random.uniform(1 - jitter, 1 + jitter)
+
+        retry_after = headers.get('Retry-After') if headers else None
+        if retry_after:
+            if retry_after.isdigit():
+                wait = int(retry_after)
+            else:
+                date = parsedate_tz(retry_after)
+                wait = mktime_tz(date) - now if date else 0
+            due = max(due, now + min(wait, self.settings.max_backoff))
+        return due
+
+    def _push(self, url, due):
+        if self._state[url].get('due') == due:
+            return
+        self._state[url]['due'] = due
+        heapq.heappush(self._queue, (due, url))
+
+    @staticmethod
+    def publish_period(entries):
+        """ Median number of seconds between the entries' publish dates. """
+        stamps = sorted(entry.time for entry in entries[:MAX_UPDATES]
+                        if entry.time is not None)
+        gaps = sorted(b - a for a, b in zip(stamps, stamps[1:]) if b > a)
+        if not gaps:
+            return None
+        return gaps[len(gaps) // 2]
+
+
+class RateLimiter(object):
+    """ Token bucket allowing `rate` acquisitions every `per` seconds. """
+
+    def __init__(self, rate, per):
+        self.rate = rate
+        self.per = per
+        self._tokens = rate
+        self._updated = time.monotonic()
+
+    async def acquire(self):
+        while True:
+            now = time.monotonic()
+            self._tokens = min(self.rate, self._tokens +
+                               (now - self._updated) * self.rate / self.per)
+            self._updated = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return
+            await asyncio.sleep((1 - self._tokens) * self.per / self.rate)
+
+
+class PostQueue(object):
+    """ Outbound posts, with one queue and worker per channel so a busy
+        channel never holds up the others or the polling loop.
+
+        A post's callback is called with whether it got sent once the
+        worker is done with it. Posts still queued or being sent on close
+        are dropped and called back as not sent.
+    """
+
+    def __init__(self, bot, settings):
+        self.bot = bot
+        self.settings = settings
+
+        # { channel_id: deque of (message, callback) }
+        self._queues = {}
+        # { channel_id: task draining that channel's queue }
+        self._workers = {}
+        # { channel_id: callbacks of the message being sent }
+        self._sending = {}
+        self._channel_limits = {}
+        self._global_limit = RateLimiter(settings.global_sends_per_second, 1)
+
+    def put(self, channel, message, callback=None):
+        self._queues.setdefault(channel.id, deque()).append(
+            (message, callback))
+        if channel.id not in self._workers:
+            self._workers[channel.id] = self.bot.loop.create_task(
+                self._drain(channel))
+
+    def pending(self):
+        return sum(len(queue) for queue in self._queues.values())
+
+    async def join(self):
+        """ Waits until every queued post has been sent. """
+        while self._workers:
+            await asyncio.wait(list(self._workers.values()))
+
+    def close(self):
+        for channel_id, worker in self._workers.items():
+            worker.cancel()
+            callbacks = list(self._sending.pop(channel_id, ()))
+            queue = self._queues.get(channel_id, ())
+            callbacks.extend(callback for message, callback in queue)
+            if queue:
+                queue.clear()
+            for callback in callbacks:
+                if callback is not None:
+                    callback(False)
+
+    async def _drain(self, channel):
+        queue = self._queues[channel.id]
+        if channel.id not in self._channel_limits:
+            self._channel_limits[channel.id] = RateLimiter(
+                self.settings.channel_sends,
+                self.settings.channel_send_window)
+        limit = self._channel_limits[channel.id]
+
+        try:
+            while queue:
+                await limit.acquire()
+                await self._global_limit.acquire()
+
+                message, callback = queue.popleft()
+                callbacks = [callback]
+                if self.settings.merge_posts:
+                    while queue and len(message) + len(queue[0][0]) + 2 <= \
+                            MAX_MESSAGE_LENGTH:
+                        merged, callback = queue.popleft()
+                        message += "\n\n" + merged
+                        callbacks.append(callback)
+
+                self._sending[channel.id] = callbacks
+                sent = False
+                try:
+                    await self.bot.send_message(channel, message)
+                    sent = True
+                except Exception:
+                    log.exception("Failure posting to channel {}".format(
+                        channel.id))
+                # close() calls back the posts it interrupts itself
+                if self._sending.pop(channel.id, None) is not callbacks:
+                    continue
+                for callback in callbacks:
+                    if callback is not None:
+                        callback(sent)
+        finally:
+            del self._workers[channel.id]
+            if not queue:
+                del self._queues[channel.id]
+
+
+class Metrics(object):
+    """ In memory poll statistics, per feed URL and per update cycle.
+
+        Times are split into connect (DNS, connection and request, up to
+        the response headers), download, parse and post, and summed over
+        every poll of the feed.
+    """
+    PHASES = ('connect', 'download', 'parse', 'post')
+
+    def __init__(self):
+        # { URL: {polls:, errors:, last_error:, last_success:, size:,
+        #         bytes:, times: {phase: seconds}} }
+        self.feeds = {}
+        self.cycles = 0
+        self.last_cycle = 0.0
+        self.last_cycle_polls = 0
+        self.last_dump = time.time()
+
+    def get(self, url):
+        if url not in self.feeds:
+            self.feeds[url] = {
+                'polls': 0,
+                'errors': 0,
+                'last_error': None,
+                'last_success': None,
+                'size': 0,
+                'bytes': 0,
+                'times': {phase: 0.0 for phase in self.PHASES}
+            }
+        return self.feeds[url]
+
+    def fetched(self, url, size=0, **timings):
+        metrics = self.get(url)
+        metrics['polls'] += 1
+        metrics['size'] = size
+        metrics['bytes'] += size
+        metrics['last_success'] = int(time.time())
+        self._add_times(metrics, timings)
+
+    def failed(self, url, error, **timings):
+        metrics = self.get(url)
+        metrics['polls'] += 1
+        metrics['errors'] += 1
+        if len(error) > MAX_ERROR_LENGTH:
+            error = error[:MAX_ERROR_LENGTH - 3] + "..."
+        metrics['last_error'] = error
+        self._add_times(metrics, timings)
+
+    def posted(self, url, seconds):
+        self.get(url)['times']['post'] += seconds
+
+    def cycle(self, seconds, polls):
+        self.cycles += 1
+        self.last_cycle = seconds
+        self.last_cycle_polls = polls
+
+    def forget(self, urls):
+        """ Drops the metrics of feeds nobody is subscribed to anymore. """
+        for url in list(self.feeds):
+            if url not in urls:
+                del self.feeds[url]
+
+    def average_time(self, url):
+        metrics = self.feeds[url]
+        if metrics['polls'] == 0:
+            return 0.0
+        return sum(metrics['times'].values()) / metrics['polls']
+
+    def slowest(self, count=STATS_TOP):
+        return sorted(self.feeds, key=self.average_time, reverse=True)[:count]
+
+    def biggest(self, count=STATS_TOP):
+        return sorted(self.feeds, key=lambda url: self.feeds[url]['bytes'],
+                      reverse=True)[:count]
+
+    def failing(self, count=STATS_TOP):
+        failing = [url for url in self.feeds if self.feeds[url]['errors']]
+        return sorted(failing, key=lambda url: self.feeds[url]['errors'],
+                      reverse=True)[:count]
+
+    async def dump(self, loop):
+        self.last_dump = time.time()
+        data = {
+            'cycles': self.cycles,
+            'last_cycle': self.last_cycle,
+            'last_cycle_polls': self.last_cycle_polls,
+            'feeds': copy.deepcopy(self.feeds)
+        }
+        try:
+            await loop.run_in_executor(None, dataIO.save_json,
+                                       METRICS_PATH, data)
+        except:
+            log.exception("Failure saving RSS metrics")
+
+    @staticmethod
+    def _add_times(metrics, timings):
+        for phase, seconds in timings.items():
+            metrics['times'][phase] += seconds
 
 
 class Feeds(object):
@@ -37,19 +465,73 @@ class Feeds(object):
         #         server: {
         #             name: {
         #                 channel_id:,template:,
-        #                 last_update:,posted:,update_time:
+        #                 last_update:,seen:,update_time:(epoch)
         #                 filtered_tag:,keyword:
         #             }
         #         }
         #     }
         # }
-        self.feeds = fileIO("data/RSS/feeds.json", "load")
+        # seen is { entry_key: posted_at } for the entries already posted.
+        # Only the subscription settings are saved to feeds.json, the
+        #  STATE_KEYS go to state.json, which is written in batches.
+        self.feeds = fileIO(FEEDS_PATH, "load")
+        self.load_state()
+        self.upgrade_state()
+
+        # { URL: {etag:, last_modified:, size:} } from the last full download,
+        #  used to make conditional requests.
+        self.validators = fileIO(VALIDATORS_PATH, "load")
+
+        self._dirty = False
+        self._flush_lock = asyncio.Lock()
 
         # A map of { server: {name: url} } ,
         #  to be able to find what url the name belongs to within a server.
         self._reverse_map = {}
         self.reload_reverse_map()
 
+    def iter_feeds(self):
+        for url, server_feeds in self.feeds.items():
+            for server_id, feeds in server_feeds.items():
+                for name, feed in feeds.items():
+                    yield url, server_id, name, feed
+
+    def load_state(self):
+        """ Merges state.json into the feeds. Files from before the split
+            still have the state in feeds.json, they're split right away.
+        """
+        if not fileIO(STATE_PATH, "check"):
+            self.save_feeds()
+            self.save_state()
+            return
+
+        state = fileIO(STATE_PATH, "load")
+        for url, server_id, name, feed in self.iter_feeds():
+            feed_state = state.get(url, {}).get(server_id, {}).get(name, {})
+            for key in STATE_KEYS:
+                if key in feed_state:
+                    feed[key] = feed_state[key]
+            feed.setdefault('last_update', "")
+            feed.setdefault('update_time', 0)
+
+    def upgrade_state(self):
+        """ Replaces the old list of posted titles with the seen dict, and
+            date strings with epoch seconds.
+        """
+        upgraded = False
+        for url, server_id, name, feed in self.iter_feeds():
+            if 'seen' not in feed:
+                feed.pop('posted', None)
+                feed['seen'] = {}
+                upgraded = True
+            if isinstance(feed.get('update_time'), str):
+                feed['update_time'] = \
+                    parse_timestamp(feed['update_time']) or 0
+                upgraded = True
+        if upgraded:
+            self.save_feeds()
+            self.save_state()
+
     def reload_reverse_map(self):
         for url, server_feeds in self.feeds.items():
             for server_id, feeds in server_feeds.items():
@@ -65,8 +547,74 @@ class Feeds(object):
             return None
         return self._reverse_map[server_id][name]
 
+    def split_feeds(self):
+        """ Returns copies of (settings, state) ready to be saved. """
+        config = {}
+        state = {}
+        for url, server_id, name, feed in self.iter_feeds():
+            feed_config = {k: v for k, v in feed.items()
+                           if k not in STATE_KEYS}
+            feed_state = {k: feed[k] for k in STATE_KEYS if k in feed}
+            if 'seen' in feed_state:
+                feed_state['seen'] = dict(feed_state['seen'])
+            config.setdefault(url, {}).setdefault(server_id, {})[name] = \
+                feed_config
+            state.setdefault(url, {}).setdefault(server_id, {})[name] = \
+                feed_state
+        # Keep URLs and servers that have no feeds left, like before
+        for url, server_feeds in self.feeds.items():
+            for server_id in server_feeds:
+                config.setdefault(url, {}).setdefault(server_id, {})
+        return config, state
+
     def save_feeds(self):
-        fileIO("data/RSS/feeds.json", "save", self.feeds)
+        """ Saves the subscriptions right away, they rarely change. """
+        dataIO.save_json(FEEDS_PATH, self.split_feeds()[0])
+
+    def save_state(self):
+        dataIO.save_json(STATE_PATH, self.split_feeds()[1])
+
+    def save_validators(self):
+        dataIO.save_json(VALIDATORS_PATH, self.validators)
+
+    def mark_dirty(self):
+        self._dirty = True
+
+    async def flush(self, loop):
+        """ Writes the state and validators changed since the last flush,
+            at most once per call and away from the event loop.
+        """
+        async with self._flush_lock:
+            if not self._dirty:
+                return
+            self._dirty = False
+            state = self.split_feeds()[1]
+            validators = copy.deepcopy(self.validators)
+
+            def write():
+                dataIO.save_json(STATE_PATH, state)
+                dataIO.save_json(VALIDATORS_PATH, validators)
+
+            try:
+                await loop.run_in_executor(None, write)
+            except:
+                self._dirty = True
+                log.exception("Failure saving RSS state")
+
+    def get_validators(self, url):
+        return self.validators.get(url, {})
+
+    def set_validators(self, url, etag, last_modified, size):
+        if etag is None and last_modified is None:
+            if self.validators.pop(url, None) is not None:
+                self.mark_dirty()
+            return
+        self.validators[url] = {
+            'etag': etag,
+            'last_modified': last_modified,
+            'size': size
+        }
+        self.mark_dirty()
 
     def check_folders(self):
         if not os.path.exists("data/RSS"):
@@ -75,11 +623,16 @@ class Feeds(object):
         self.check_files()
 
     def check_files(self):
-        f = "data/RSS/feeds.json"
+        f = FEEDS_PATH
         if not fileIO(f, "check"):
             print("Creating empty feeds.json...")
             fileIO(f, "save", {})
 
+        f = VALIDATORS_PATH
+        if not fileIO(f, "check"):
+            print("Creating empty validators.json...")
+            fileIO(f, "save", {})
+
     def add_feed(self, server_id, channel_id, name, url, filtered_tag, keyword):
         if filtered_tag is None or keyword is None:
             filtered_tag = ""
@@ -96,13 +649,15 @@ class Feeds(object):
             'mention': "",
             'filtered_tag': filtered_tag,
             'keyword': keyword,
+            'filter_syntax': FILTER_SYNTAX,
             'last_update': "",
-            'update_time': "",
-            'posted': []
+            'update_time': 0,
+            'seen': {}
         }
 
         self.feeds[url][server_id][name] = new_feed
         self.save_feeds()
+        self.mark_dirty()
 
         if server_id not in self._reverse_map:
             self._reverse_map[server_id] = {}
@@ -122,9 +677,10 @@ class Feeds(object):
         del self._reverse_map[server_id][name]
 
         self.save_feeds()
+        self.mark_dirty()
         return True
 
-    def update_feed(self, server_id, name, latest_title: str, update_time: str):
+    def update_feed(self, server_id, name, latest_title: str, update_time):
         url = self.get_url_for_name(server_id, name)
 
         if url is not None and url in self.feeds:
@@ -132,20 +688,52 @@ class Feeds(object):
                 if name in self.feeds[url][server_id]:
                     feed = self.feeds[url][server_id][name]
 
-                    if feed['update_time'] != update_time:
-                        feed['posted'] = []
                     feed['last_update'] = latest_title
                     feed['update_time'] = update_time
+                    self.mark_dirty()
 
-                    self.feeds[url][server_id][name] = feed
-                    self.save_feeds()
+    def rewind_feed(self, server_id, name, update_time):
+        url = self.get_url_for_name(server_id, name)
+
+        if url is not None and url in self.feeds:
+            if server_id in self.feeds[url]:
+                if name in self.feeds[url][server_id]:
+                    feed = self.feeds[url][server_id][name]
+
+                    if feed['update_time'] > update_time:
+                        feed['update_time'] = update_time
+                        self.mark_dirty()
 
-    def posted(self, server_id, name, title):
+    def posted(self, server_id, name, entry_key):
         url = self.get_url_for_name(server_id, name)
         if url is not None and url in self.feeds:
-            if name in self.feeds[url]:
-                self.feeds[url][name]['posted'].append(title)
-                self.save_feeds()
+            if server_id in self.feeds[url]:
+                if name in self.feeds[url][server_id]:
+                    seen = self.feeds[url][server_id][name]['seen']
+                    seen[entry_key] = int(time.time())
+                    Feeds.prune_seen(seen)
+                    self.mark_dirty()
+
+    @staticmethod
+    def prune_seen(seen):
+        """ Forgets entries older than SEEN_MAX_AGE, then the oldest ones
+            until at most SEEN_LIMIT are left.
+        """
+        cutoff = time.time() - SEEN_MAX_AGE
+        for key in [k for k, t in seen.items() if t < cutoff]:
+            del seen[key]
+
+        if len(seen) > SEEN_LIMIT:
+            oldest = sorted(seen, key=seen.get)[:len(seen) - SEEN_LIMIT]
+            for key in oldest:
+                del seen[key]
+
+    @staticmethod
+    def entry_key(entry):
+        """ Short hash of the entry's guid, falling back to link/title. """
+        ident = entry.get('id') or entry.get('link') or \
+            entry.get('title', '')
+        return hashlib.sha1(ident.encode('utf-8')).hexdigest()[:16]
 
     async def edit_template(self, server_id, name, template):
         url = self.get_url_for_name(server_id, name)
@@ -197,31 +785,290 @@ class Feeds(object):
         return self.feeds.copy()
 
     @staticmethod
-    async def get_feed_at(url):
-        text = None
+    async def get_feed_at(session, url, max_size):
+        body = None
         try:
-            with aiohttp.ClientSession() as session:
-                with aiohttp.Timeout(3):
-                    async with session.get(url) as r:
-                        text = await r.text()
+            with aiohttp.Timeout(3):
+                async with session.get(url) as r:
+                    body = await Feeds.read_body(r, max_size)
         except:
             pass
-        return text
+        return body
 
     @staticmethod
-    async def valid_url(url):
-        text = await Feeds.get_feed_at(url)
-        rss = feedparser.parse(text)
+    async def read_body(resp, max_size):
+        """ Streams a response's body, giving up (returning None) as soon as
+            it grows past max_size or clearly isn't an XML document.
+        """
+        length = resp.headers.get('Content-Length')
+        if length is not None and length.isdigit() and \
+                int(length) > max_size:
+            log.debug("Feed too big ({} bytes)".format(length))
+            return None
 
-        return not bool(rss.bozo)
+        body = bytearray()
+        while True:
+            chunk = await resp.content.read(READ_CHUNK)
+            if not chunk:
+                break
+            if not body and not Feeds.looks_like_xml(chunk):
+                log.debug("Feed isn't an XML document")
+                return None
+            body.extend(chunk)
+            if len(body) > max_size:
+                log.debug("Feed too big (over {} bytes)".format(max_size))
+                return None
+        return bytes(body)
 
     @staticmethod
-    def rss_time_from(time_str: str):
-        return datetime.strptime(time_str, '%a, %d %b %Y %H:%M:%S %z')
+    def looks_like_xml(head: bytes):
+        for bom in XML_BOMS:
+            if head.startswith(bom):
+                return True
+        return head.lstrip().startswith(b'<')
 
     @staticmethod
-    def rss_time_to_str(time: datetime):
-        return time.strftime('%a, %d %b %Y %H:%M:%S %z')
+    async def valid_url(session, url, max_size, executor=None):
+        body = await Feeds.get_feed_at(session, url, max_size)
+        if body is None:
+            return False
+        loop = asyncio.get_event_loop()
+        rss = await loop.run_in_executor(executor, feedparser.parse, body)
+
+        return not bool(rss.bozo)
+
+
+class FeedEntry(object):
+    """ An entry worked out once per fetch and shared by every
+        subscription to its URL.
+    """
+    __slots__ = ('key', 'title', 'time', 'fields', 'found')
+
+    def __init__(self, entry):
+        self.key = Feeds.entry_key(entry)
+        self.title = entry.get('title', "")
+        # Epoch seconds, None for undated entries
+        self.time = entry_time(entry)
+        # What templates and filters see
+        self.fields = entry
+        # { tag: words found in it } when a FilterSet scanned the entry
+        self.found = {}
+
+
+def entry_time(entry):
+    """ Prefers the dates feedparser already parsed (UTC struct_times),
+        then falls back on parsing the raw strings.
+    """
+    for key in ('published_parsed', 'updated_parsed', 'created_parsed'):
+        parsed = entry.get(key)
+        if parsed:
+            return calendar.timegm(parsed)
+    for key in ('published', 'updated', 'created'):
+        if entry.get(key):
+            stamp = parse_timestamp(entry[key])
+            if stamp is not None:
+                return stamp
+    return None
+
+
+@functools.lru_cache(maxsize=4096)
+def parse_timestamp(text):
+    """ Epoch seconds for an RFC 822 or ISO 8601 date, None if neither. """
+    text = text.strip()
+    parsed = parsedate_tz(text)
+    if parsed is not None:
+        return mktime_tz(parsed)
+
+    if text.endswith('Z'):
+        text = text[:-1] + '+0000'
+    text = ISO_OFFSET_RE.sub(r'\1\2', text)
+    for fmt in ISO_FORMATS:
+        try:
+            return int(datetime.strptime(text, fmt).timestamp())
+        except ValueError:
+            pass
+    return None
+
+
+def parse_feed(body):
+    """ Parses a document and normalizes its entries, in the parser pool. """
+    rss = feedparser.parse(body)
+    if rss.bozo:
+        return rss, []
+    return rss, [FeedEntry(entry) for entry in rss.entries]
+
+
+@functools.lru_cache(maxsize=256)
+def compile_template(template):
+    return string.Template(template)
+
+
+def field_text(fields, tag):
+    value = fields.get(tag, "")
+    return value if isinstance(value, str) else str(value)
+
+
+class KeywordFilter(object):
+    """ A subscription's keyword filter on one of the entries' tags.
+
+        The keyword is a list of clauses separated by |, any of which has
+        to match. A clause is a list of terms joined by &, all of which
+        have to match. A term is a word the tag must contain, or a prefix
+        it must start with when written as >prefix, and ! negates it. A
+        keyword starting with re: (or !re:) is a single regular expression
+        instead. Keywords with syntax 1 are a single word, or a >prefix.
+    """
+    __slots__ = ('tag', 'clauses', 'words')
+
+    def __init__(self, tag, keyword, syntax=FILTER_SYNTAX):
+        self.tag = tag
+        # [[(kind, value, negated)]]
+        self.clauses = []
+        # The TERM_WORD values, what a FilterSet looks for
+        self.words = set()
+
+        if syntax < 2:
+            if keyword.startswith('>'):
+                self.clauses.append(
+                    [(TERM_PREFIX, keyword.replace('>', ''), False)])
+            else:
+                self.clauses.append([(TERM_WORD, keyword, False)])
+                if keyword:
+                    self.words.add(keyword)
+            return
+
+        if keyword.startswith(('re:', '!re:')):
+            negated = keyword.startswith('!')
+            try:
+                pattern = re.compile(keyword.split(':', 1)[1])
+            except re.error as e:
+                raise ValueError("Invalid regular expression: {}".format(e))
+            self.clauses.append([(TERM_REGEX, pattern, negated)])
+            return
+
+        for clause in keyword.split('|'):
+            terms = []
+            for term in clause.split('&'):
+                negated = term.startswith('!')
+                if negated:
+                    term = term[1:]
+                if term.startswith('>'):
+                    terms.append((TERM_PREFIX, term[1:], negated))
+                else:
+                    terms.append((TERM_WORD, term, negated))
+                    if term:
+                        self.words.add(term)
+            self.clauses.append(terms)
+
+    def matches(self, fields, found=None):
+        """ found is the set of this tag's words known to be in the entry,
+            when a FilterSet already searched for them.
+        """
+        text = field_text(fields, self.tag)
+        for clause in self.clauses:
+            for kind, value, negated in clause:
+                if kind == TERM_WORD:
+                    if found is not None:
+                        hit = not value or value in found
+                    else:
+                        hit = value in text
+                elif kind == TERM_PREFIX:
+                    hit = text.startswith(value)
+                else:
+                    hit = value.search(text) is not None
+                if hit == negated:
+                    break
+            else:
+                return True
+        return False
+
+
+class Automaton(object):
+    """ Aho-Corasick automaton, finds which of many words appear in a text
+        in a single pass over it.
+    """
+
+    def __init__(self, words):
+        self.goto = [{}]
+        self.fail = [0]
+        self.out = [frozenset()]
+
+        for word in words:
+            state = 0
+            for char in word:
+                if char not in self.goto[state]:
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.out.append(frozenset())
+                    self.goto[state][char] = len(self.goto) - 1
+                state = self.goto[state][char]
+            self.out[state] = self.out[state] | {word}
+
+        queue = deque(self.goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, child in self.goto[state].items():
+                queue.append(child)
+                fail = self.fail[state]
+                while fail and char not in self.goto[fail]:
+                    fail = self.fail[fail]
+                self.fail[child] = self.goto[fail].get(char, 0)
+                self.out[child] = self.out[child] | self.out[self.fail[child]]
+
+    def search(self, text):
+        goto = self.goto
+        fail = self.fail
+        out = self.out
+        found = set()
+        state = 0
+        for char in text:
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            if out[state]:
+                found |= out[state]
+        return found
+
+
+class FilterSet(object):
+    """ The filters of every subscription to a URL, searching each entry
+        once per tag for all of their words.
+    """
+
+    def __init__(self, filters):
+        words = defaultdict(set)
+        for keyword_filter in filters:
+            words[keyword_filter.tag] |= keyword_filter.words
+
+        self.automata = {tag: Automaton(tag_words)
+                         for tag, tag_words in words.items()
+                         if len(tag_words) >= COMBINED_FILTER_MIN}
+
+    def scan(self, fields):
+        return {tag: automaton.search(field_text(fields, tag))
+                for tag, automaton in self.automata.items()}
+
+
+@functools.lru_cache(maxsize=256)
+def compile_filter(tag, keyword, syntax=FILTER_SYNTAX):
+    """ Returns the subscription's KeywordFilter, None if it has none.
+        Raises ValueError if the keyword can't be compiled.
+    """
+    if tag == "":
+        return None
+    return KeywordFilter(tag, keyword, syntax)
+
+
+@functools.lru_cache(maxsize=64)
+def compile_filter_set(filters):
+    """ filters is a sorted tuple of (tag, keyword, syntax) """
+    compiled = []
+    for tag, keyword, syntax in filters:
+        try:
+            compiled.append(compile_filter(tag, keyword, syntax))
+        except ValueError:
+            pass
+    return FilterSet(filter(None, compiled))
 
 
 class RSS(object):
@@ -230,10 +1077,42 @@ class RSS(object):
 
         self.settings = Settings()
         self.feeds = Feeds()
-        self.session = aiohttp.ClientSession()
+        # One pooled session for every request the cog makes, so polls
+        #  reuse connections and DNS lookups
+        connector = aiohttp.TCPConnector(
+            limit=self.settings.max_fetches,
+            use_dns_cache=True,
+            keepalive_timeout=KEEPALIVE_TIMEOUT
+        )
+        self.session = aiohttp.ClientSession(
+            connector=connector,
+            headers={'Accept-Encoding': 'gzip, deflate'}
+        )
+        self.parser = ThreadPoolExecutor(self.settings.parse_workers)
+        self.scheduler = Scheduler(self.settings)
+        self.posts = PostQueue(bot, self.settings)
+        # (server_id, name, entry key) of the posts waiting in self.posts,
+        #   so later polls don't queue them a second time
+        self.queued_posts = set()
+        # { (server_id, name): {entry key: time} } of posts that failed or
+        #   were dropped, the feed's cursor isn't moved past them
+        self.unsent_posts = {}
+        self.metrics = Metrics()
+
+        # Conditional request counters since the cog was loaded
+        self.conditional_stats = {
+            'requests': 0,
+            'not_modified': 0,
+            'bytes_saved': 0
+        }
 
     def __unload(self):
         self.session.close()
+        self.parser.shutdown(wait=False)
+        self.posts.close()
+        if self.feeds._dirty:
+            self.feeds.save_state()
+            self.feeds.save_validators()
 
     def get_channel_object(self, channel_id):
         channel = self.bot.get_channel(channel_id)
@@ -255,6 +1134,10 @@ class RSS(object):
         """ Add an RSS feed to the current channel.
             You can provide a `keyword` to filter the feed by the `filtered`
             tag's content.
+
+            Keywords can be combined: a|b matches either, a&b both and !a
+            excludes a. >a checks that the tag starts with a, and re:... is
+            a regular expression. Use _ for spaces, except in re:.
         """
 
         if filtered is not None and keyword == "":
@@ -262,6 +1145,17 @@ class RSS(object):
                                "provide a keyword to check for.")
             return
 
+        # Underscores stand for spaces, except in regular expressions
+        if not keyword.startswith(('re:', '!re:')):
+            keyword = keyword.replace('_', ' ')
+
+        if filtered is not None:
+            try:
+                compile_filter(filtered, keyword)
+            except ValueError as e:
+                await self.bot.say("Invalid keyword: {}".format(e))
+                return
+
         server = ctx.message.server
         channel = ctx.message.channel
 
@@ -270,7 +1164,9 @@ class RSS(object):
                                "through direct messages.")
             return
 
-        valid_url = await Feeds.valid_url(url)
+        valid_url = await Feeds.valid_url(self.session, url,
+                                          self.settings.max_feed_size,
+                                          self.parser)
         if not valid_url:
             await self.bot.send_message(
                 channel,
@@ -279,12 +1175,13 @@ class RSS(object):
 
         self.feeds.add_feed(
             server.id, channel.id, name, url,
-            filtered, keyword.replace('_', ' ')
+            filtered, keyword
         )
 
         post_time, title = await self.get_last_entry(url)
 
         self.feeds.update_feed(server.id, name, title, post_time)
+        await self.feeds.flush(self.bot.loop)
 
         await self.bot.say(
             'Feed "{}" added. Modify the template using'
@@ -345,6 +1242,72 @@ class RSS(object):
         else:
             await self.bot.say('Feed not found!')
 
+    @rss.command(name="stats")
+    async def _rss_stats(self):
+        """ Shows poll timings, the slowest, biggest and failing feeds and
+            how much conditional requests are saving.
+        """
+        stats = self.conditional_stats
+        rate = 0
+        if stats['requests'] > 0:
+            rate = stats['not_modified'] / stats['requests'] * 100
+        metrics = self.metrics
+
+        msg = ("Conditional requests: {}\n"
+               "Not modified (304):   {} ({:.1f}%)\n"
+               "Bytes saved:          {}\n"
+               "Last cycle:           {:.2f}s, {} feeds polled\n"
+               "Cycles:               {}\n"
+               "Queued posts:         {}\n".format(
+                   stats['requests'], stats['not_modified'], rate,
+                   stats['bytes_saved'], metrics.last_cycle,
+                   metrics.last_cycle_polls, metrics.cycles,
+                   self.posts.pending()))
+
+        slowest = metrics.slowest()
+        if slowest:
+            msg += "\nSlowest feeds (average per poll, " \
+                   "connect/download/parse/post):\n"
+            for url in slowest:
+                feed = metrics.feeds[url]
+                polls = max(1, feed['polls'])
+                msg += "{:.2f}s ({}) {}\n".format(
+                    metrics.average_time(url),
+                    "/".join("{:.2f}".format(feed['times'][phase] / polls)
+                             for phase in Metrics.PHASES),
+                    self.short_url(url))
+
+        biggest = metrics.biggest()
+        if biggest:
+            msg += "\nMost downloaded feeds (total, last):\n"
+            for url in biggest:
+                feed = metrics.feeds[url]
+                msg += "{:.1f}KB, {:.1f}KB {}\n".format(
+                    feed['bytes'] / 1024, feed['size'] / 1024,
+                    self.short_url(url))
+
+        failing = metrics.failing()
+        if failing:
+            msg += "\nFailing feeds (errors/polls, last success):\n"
+            for url in failing:
+                feed = metrics.feeds[url]
+                last_success = "never"
+                if feed['last_success'] is not None:
+                    last_success = datetime.utcfromtimestamp(
+                        feed['last_success']).strftime('%Y-%m-%d %H:%M')
+                msg += "{}/{}, {} {}\n    {}\n".format(
+                    feed['errors'], feed['polls'], last_success,
+                    self.short_url(url), feed['last_error'])
+
+        for page in pagify(msg, delims=["\n"]):
+            await self.bot.say(box(page))
+
+    @staticmethod
+    def short_url(url, length=50):
+        if len(url) <= length:
+            return url
+        return url[:length - 3] + "..."
+
     @rss.command(pass_context=True, name="template")
     async def _rss_template(self, ctx, feed_name: str, *, template: str):
         ("""Set a template for the feed alert
@@ -400,6 +1363,7 @@ class RSS(object):
         result = await self.post_feed_updates(
             server.id, feed_name, items, await self.get_feed_entries(url)
         )
+        await self.feeds.flush(self.bot.loop)
 
         if result is None:
             message = "Error while trying to find the channel. " \
@@ -416,114 +1380,254 @@ class RSS(object):
     async def post_feed_updates(self, server_id, name, items, entries):
         log.debug("Posting updates for feed {}".format(name))
 
-        template = items['template']
+        template = compile_template(items['template'])
+        try:
+            keyword_filter = compile_filter(items['filtered_tag'],
+                                            items['keyword'],
+                                            items.get('filter_syntax', 1))
+        except ValueError as e:
+            log.warning("Bad filter for feed {}: {}".format(name, e))
+            return False
 
         channel = self.get_channel_object(items['channel_id'])
         if channel is None:
             return None
 
-        if items['update_time'] == "":
-            last_time = Feeds.rss_time_from(entries[0].published)
-        else:
-            last_time = Feeds.rss_time_from(items['update_time'])
+        last_time = items['update_time'] or entries[0].time
 
         result = False
         last_idx = len(entries)
-        for idx, entry in enumerate(entries):
-            if last_time > Feeds.rss_time_from(entry.published):
-                last_idx = idx
-                break
+        if last_time is not None:
+            # Undated entries are left to the seen check
+            for idx, entry in enumerate(entries):
+                if entry.time is not None and last_time > entry.time:
+                    last_idx = idx
+                    break
 
         # Limit entries to be posted. Latest 10 by default.
         last_idx = min(MAX_UPDATES, last_idx)
 
         for entry in entries[:last_idx][::-1]:
             title = entry.title
-            if title == items['last_update'] or title in items['posted']:
+            post_key = (server_id, name, entry.key)
+            if title == items['last_update'] or \
+                    entry.key in items['seen'] or \
+                    post_key in self.queued_posts:
                 continue
 
-            if items['filtered_tag'] != "":
-                filtered_tag = getattr(entry, items['filtered_tag'])
-                kw = items['keyword']
-
-                if kw.startswith('>'):
-                    if not filtered_tag.startswith(kw.replace('>', '')):
-                        log.debug("Entry does not start with keyword {} in {}"
-                                  .format(kw, items['filtered_tag']))
-                        continue
-
-                elif kw not in filtered_tag:
-                    log.debug("Entry does not contain keyword {} in {}"
-                              .format(kw, items['filtered_tag']))
-                    continue
+            if keyword_filter is not None and not keyword_filter.matches(
+                    entry.fields, entry.found.get(keyword_filter.tag)):
+                log.debug("Entry does not match keyword {} in {}"
+                          .format(items['keyword'], items['filtered_tag']))
+                continue
 
-            to_fill = string.Template(template)
-            message = to_fill.safe_substitute(
+            message = template.safe_substitute(
                 name=bold(name),
-                **entry
+                **entry.fields
             )
 
             if message is not None:
-                await self.bot.send_message(channel, message)
-
-                self.feeds.update_feed(server_id, name, title, entry.published)
-                self.feeds.posted(server_id, name, title)
+                # Only recorded once it's sent, a post lost to a failed send
+                #  or an unload goes out again on a later poll
+                self.queued_posts.add(post_key)
+                self.posts.put(channel, message, functools.partial(
+                    self.post_sent, post_key, title,
+                    entry.time or last_time or 0))
 
                 result = True
 
         return result
 
+    def post_sent(self, post_key, title, update_time, sent):
+        self.queued_posts.discard(post_key)
+        server_id, name, entry_key = post_key
+        unsent = self.unsent_posts.setdefault((server_id, name), {})
+        if sent:
+            unsent.pop(entry_key, None)
+            if unsent:
+                update_time = min(update_time, min(unsent.values()))
+            else:
+                del self.unsent_posts[(server_id, name)]
+            self.feeds.update_feed(server_id, name, title, update_time)
+            self.feeds.posted(server_id, name, entry_key)
+            return
+
+        # Rewind the cursor to the post, and forget the feed's validators
+        #  so the next poll isn't answered with a 304 and posts it again
+        unsent[entry_key] = update_time
+        self.feeds.rewind_feed(server_id, name, update_time)
+        url = self.feeds.get_url_for_name(server_id, name)
+        if url is not None:
+            self.feeds.set_validators(url, None, None, 0)
+
     async def check_updates(self):
+        """ Polls the feeds that are due, until the cog is unloaded. """
         await self.bot.wait_until_ready()
 
         while self == self.bot.get_cog('RSS'):
             all_feeds = self.feeds.get_copy()
+            self.scheduler.sync(all_feeds)
+            self.metrics.forget(all_feeds)
 
-            for url, feeds in all_feeds.items():
-                rss_entries = await self.get_feed_entries(url)
-                if rss_entries is None:
-                    continue
+            await self.poll_feeds(all_feeds, self.scheduler.pop_due())
+            await self.feeds.flush(self.bot.loop)
 
-                for server_id, server_feeds in feeds.items():
+            interval = self.settings.metrics_interval
+            if interval and time.time() - self.metrics.last_dump >= interval:
+                await self.metrics.dump(self.bot.loop)
 
-                    for name, items in server_feeds.items():
-                        log.debug("Checking {} with URL {}".format(name, url))
+            next_due = self.scheduler.next_due()
+            delay = SCHEDULER_TICK
+            if next_due is not None:
+                delay = min(delay, max(0, next_due - time.time()))
+            await asyncio.sleep(delay)
 
-                        result = await self.post_feed_updates(
-                            server_id, name, items, rss_entries
-                        )
+    async def poll_feeds(self, all_feeds, urls):
+        """ Fetches and parses each of the URLs once, then fans the entries
+            out to all of their subscriptions.
+        """
+        if not urls:
+            return
+        cycle_start = time.monotonic()
+
+        fetches = asyncio.Semaphore(self.settings.max_fetches)
+        host_fetches = defaultdict(lambda: asyncio.Semaphore(
+            self.settings.max_fetches_per_host))
+
+        async def fetch(url):
+            # Queue on the host first, otherwise feeds waiting on a busy
+            #   host would sit on global slots other hosts could be using
+            async with host_fetches[urlparse(url).netloc], fetches:
+                try:
+                    return url, await self.get_feed_entries(
+                        url, conditional=True)
+                except Exception:
+                    # The URL was popped off the schedule, it has to be put
+                    #   back or it would never be polled again
+                    log.exception("Failure fetching feed at URL:\n\t"
+                                  "{}".format(url))
+                    self.scheduler.failed(url)
+                    return url, None
+
+        # Post whatever comes back first instead of waiting on slow feeds
+        for next_done in asyncio.as_completed([fetch(url) for url in urls]):
+            url, rss_entries = await next_done
+            if rss_entries is None:
+                continue
+            feeds = all_feeds[url]
+            post_start = time.monotonic()
+
+            filters = tuple(sorted({
+                (items['filtered_tag'], items['keyword'],
+                 items.get('filter_syntax', 1))
+                for server_feeds in feeds.values()
+                for items in server_feeds.values()
+                if items['filtered_tag'] != ""}))
+            if filters:
+                filter_set = compile_filter_set(filters)
+                if filter_set.automata:
+                    for entry in rss_entries:
+                        entry.found = filter_set.scan(entry.fields)
+
+            for server_id, server_feeds in feeds.items():
+
+                for name, items in server_feeds.items():
+                    log.debug("Checking {} with URL {}".format(name, url))
+
+                    result = await self.post_feed_updates(
+                        server_id, name, items, rss_entries
+                    )
+
+                    if result is None:
+                        log.debug("Channel not found for feed " +
+                                  name + ".")
+                        continue
 
-                        if result is None:
-                            log.debug("Channel not found for feed " +
-                                      name + ".")
-                            continue
+            self.metrics.posted(url, time.monotonic() - post_start)
 
-            await asyncio.sleep(300)
+        self.metrics.cycle(time.monotonic() - cycle_start, len(urls))
 
-    async def get_feed_entries(self, url):
+    async def get_feed_entries(self, url, conditional=False):
+        """ Returns the feed's entries, or None if there's nothing to post.
+            A conditional fetch returns None when the feed is unchanged.
+        """
+        headers = {}
+        validators = self.feeds.get_validators(url) if conditional else {}
+        if validators.get('etag'):
+            headers['If-None-Match'] = validators['etag']
+        if validators.get('last_modified'):
+            headers['If-Modified-Since'] = validators['last_modified']
+
+        start = time.monotonic()
+        connected = None
         try:
-            async with self.session.get(url) as resp:
-                html = await resp.read()
-        except:
+            with aiohttp.Timeout(self.settings.fetch_timeout):
+                async with self.session.get(url, headers=headers) as resp:
+                    connected = time.monotonic()
+                    if headers:
+                        self.conditional_stats['requests'] += 1
+                    if resp.status == 304:
+                        log.debug("Feed not modified at {}".format(url))
+                        self.conditional_stats['not_modified'] += 1
+                        self.conditional_stats['bytes_saved'] += \
+                            validators.get('size', 0)
+                        self.scheduler.fetched(url, resp.headers)
+                        self.metrics.fetched(url, connect=connected - start)
+                        return None
+                    if resp.status >= 400:
+                        log.debug("Feed at {} returned {}".format(
+                            url, resp.status))
+                        self.scheduler.failed(url, resp.headers)
+                        self.metrics.failed(url, "HTTP {}".format(
+                            resp.status), connect=connected - start)
+                        return None
+                    response_headers = resp.headers
+                    html = await Feeds.read_body(
+                        resp, self.settings.max_feed_size)
+                    etag = resp.headers.get('ETag')
+                    last_modified = resp.headers.get('Last-Modified')
+        except Exception as e:
             log.exception("Failure accessing feed at URL:\n\t{}".format(url))
+            self.scheduler.failed(url)
+            failed_at = connected or time.monotonic()
+            self.metrics.failed(url, repr(e), connect=failed_at - start)
             return None
+        downloaded = time.monotonic()
+        timings = {'connect': connected - start,
+                   'download': downloaded - connected}
 
-        rss = feedparser.parse(html)
+        if html is None:
+            self.scheduler.failed(url)
+            self.metrics.failed(url, "Too big or not XML", **timings)
+            return None
+
+        self.feeds.set_validators(url, etag, last_modified, len(html))
+
+        rss, entries = await self.bot.loop.run_in_executor(
+            self.parser, parse_feed, html)
+        timings['parse'] = time.monotonic() - downloaded
 
         if rss.bozo:
             log.debug("Feed at url below is bad.\n\t{}".format(url))
+            self.scheduler.failed(url)
+            self.metrics.failed(url, "Bad feed: {}".format(
+                rss.get('bozo_exception')), **timings)
             return None
 
-        if len(rss.entries) <= 0:
+        self.scheduler.fetched(url, response_headers, rss.feed.get('ttl'),
+                               entries)
+        self.metrics.fetched(url, len(html), **timings)
+
+        if len(entries) <= 0:
             log.debug("No entries found for feed at {}".format(url))
             return None
 
-        return rss.entries
+        return entries
 
     async def get_last_entry(self, url):
         entries = await self.get_feed_entries(url)
 
-        return entries[0].published, entries[0].title
+        return entries[0].time or 0, entries[0].title
 
 
 def setup(bot):